@@ -0,0 +1,112 @@
+# Description: Import time of every handler, as paid on a cold start. Each
+# handler file is loaded in a fresh interpreter with python -X importtime,
+# several times, and the median total is reported together with the slowest
+# modules imported directly by the handler and its helper modules.
+#
+# python benchmark/import_time.py
+# python benchmark/import_time.py --runs 10 --top 8
+
+# Import relevant modules
+import argparse
+import glob
+import os
+import statistics
+import subprocess
+import sys
+
+SAMPLE_CODE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sample_code')
+
+# Loads a handler the way Lambda does, by file, with its module level code
+LOADER = (
+    'import importlib.util, sys;'
+    'sys.path.insert(0, sys.argv[1]);'
+    'spec = importlib.util.spec_from_file_location("handler", sys.argv[2]);'
+    'spec.loader.exec_module(importlib.util.module_from_spec(spec))'
+)
+
+# Placeholder configuration, enough for every handler to get through its module
+# level code without an AWS call
+ENVIRONMENT = {
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'connect_instance_id': 'import-time',
+    'channel_voice': 'VOICE',
+    'grouping_queue': 'QUEUE',
+    'namespace': 'ImportTime',
+    'path': 'reports/',
+    'region': 'us-east-1',
+    'bucket_name': 'import-time',
+    'charset': 'utf-8',
+    'sender': 'sender@example.com',
+    'recipient_default': 'recipient@example.com',
+    'cc_default': 'cc@example.com',
+    'subject': 'Report',
+    'return_path': 'sender@example.com',
+    'reply_to': 'sender@example.com',
+    'routing_rules': '[]'
+}
+
+
+def handler_files():
+    return sorted(
+        path for path in glob.glob(os.path.join(SAMPLE_CODE, '*.py'))
+        if 'def lambda_handler' in open(path).read()
+    )
+
+
+# Returns (total microseconds, {module: cumulative microseconds}) for the
+# modules imported at the outermost level; without a path only the loader's
+# own imports are measured, i.e. the interpreter start-up
+def measure(path=None):
+    code = LOADER if path else LOADER.split(';')[0]
+
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code, SAMPLE_CODE, path or ''],
+        env=dict(os.environ, **ENVIRONMENT),
+        capture_output=True,
+        text=True,
+        check=True
+    )
+
+    total = 0
+    top_level = {}
+
+    # import time: self [us] | cumulative | imported package
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        total += int(self_us)
+
+        # Nested imports are indented below the module that imported them
+        if not name.startswith('  '):
+            top_level[name.strip()] = int(cumulative_us)
+
+    return total, top_level
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure the import time of every handler')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per handler, the median is reported')
+    parser.add_argument('--top', type=int, default=5, help='slowest top level imports to list per handler')
+    args = parser.parse_args(argv)
+
+    # Paid by every handler before its first import, subtract it to compare
+    print(f'(interpreter start-up): {statistics.median(measure()[0] for run in range(args.runs)) / 1000:.1f} ms')
+
+    for path in handler_files():
+        measurements = [measure(path) for run in range(args.runs)]
+        median_total = statistics.median(total for total, top_level in measurements)
+
+        # The slowest imports of the median run
+        total, top_level = sorted(measurements)[len(measurements) // 2]
+        slowest = sorted(top_level.items(), key=lambda item: item[1], reverse=True)[:args.top]
+
+        print(f'{os.path.basename(path)}: {median_total / 1000:.1f} ms')
+
+        for name, cumulative in slowest:
+            print(f'    {name:<40} {cumulative / 1000:8.1f} ms')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
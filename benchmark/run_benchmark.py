@@ -0,0 +1,213 @@
+# Description: Offline benchmark for the Connect pollers. Runs the
+# lambda_handler of the realtime, daily and hourly files against the local
+# stand-ins in stand_ins.py for a range of queue counts, twice each (a cold run
+# with nothing cached and a warm run in the same container), and reports the
+# wall time, the API calls per service, the peak memory traced by tracemalloc
+# and the bytes written to the log. The results can be saved as a baseline and
+# later runs compared against it.
+#
+# python benchmark/run_benchmark.py --queues 10,100,1000,5000 --save benchmark/baseline.json
+# python benchmark/run_benchmark.py --compare benchmark/baseline.json
+
+# Import relevant modules
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from stand_ins import StandInCloudWatch, StandInConnect, StandInContext
+
+SAMPLE_CODE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sample_code')
+sys.path.insert(0, SAMPLE_CODE)
+
+HANDLERS = {
+    'realtime': 'connect-get-realtime-data.py',
+    'daily': 'connect-get-historical-data.py',
+    'hourly': 'connect-get-historical-data-hourly.py'
+}
+
+# Counters that should not change between runs of the same code
+EXACT_FIELDS = ('connect_calls', 'cloudwatch_calls', 'datums')
+
+# Measurements that vary from run to run (the log holds timestamps); only a
+# rise beyond the tolerance counts
+MEASURED_FIELDS = ('wall_ms', 'peak_kb', 'log_bytes')
+
+
+# Counts what the handler writes to stdout instead of printing it
+class CountingStream:
+
+    def __init__(self):
+        self.byte_count = 0
+
+    def write(self, text):
+        self.byte_count += len(text.encode('utf-8'))
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def load_handler(file_name, module_name):
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(SAMPLE_CODE, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_invocation(module, connect, cloudwatch):
+    connect_before = connect.call_count()
+    cloudwatch_before = cloudwatch.call_count()
+    datums_before = cloudwatch.datum_count
+
+    log = CountingStream()
+    tracemalloc.start()
+    started = time.perf_counter()
+
+    with contextlib.redirect_stdout(log):
+        status = module.lambda_handler({}, StandInContext())
+
+    wall_seconds = time.perf_counter() - started
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'status': status,
+        'wall_ms': round(wall_seconds * 1000, 1),
+        'connect_calls': connect.call_count() - connect_before,
+        'cloudwatch_calls': cloudwatch.call_count() - cloudwatch_before,
+        'datums': cloudwatch.datum_count - datums_before,
+        'peak_kb': round(peak_bytes / 1024, 1),
+        'log_bytes': log.byte_count
+    }
+
+
+def run_scenario(name, queue_count, latency_seconds, state_directory):
+    from client_cache import clients
+
+    connect = StandInConnect(queue_count, latency_seconds)
+    cloudwatch = StandInCloudWatch(latency_seconds)
+    clients.register('connect', connect)
+    clients.register('cloudwatch', cloudwatch)
+
+    # A separate instance id per scenario, so that nothing cached by an earlier
+    # scenario is reused
+    instance_id = f'bench-{name}-{queue_count}'
+    os.environ.update({
+        'connect_instance_id': instance_id,
+        'channel_voice': 'VOICE',
+        'grouping_queue': 'QUEUE',
+        'namespace': 'Benchmark',
+        'queue_cache_path': os.path.join(state_directory, f'{instance_id}-queues.json'),
+        'daily_state_path': os.path.join(state_directory, f'{instance_id}-daily.json'),
+        'hourly_state_path': os.path.join(state_directory, f'{instance_id}-hourly.json'),
+        'delta_state_path': os.path.join(state_directory, f'{instance_id}-delta.json')
+    })
+
+    with contextlib.redirect_stdout(CountingStream()):
+        module = load_handler(HANDLERS[name], f'bench_{name}_{queue_count}')
+
+    rows = []
+
+    for run in ('cold', 'warm'):
+        row = {'handler': name, 'queues': queue_count, 'run': run}
+        row.update(run_invocation(module, connect, cloudwatch))
+        rows.append(row)
+
+    return rows
+
+
+def row_key(row):
+    return f"{row['handler']}/{row['queues']}/{row['run']}"
+
+
+def print_rows(rows):
+    columns = ('handler', 'queues', 'run', 'wall_ms', 'connect_calls', 'cloudwatch_calls', 'datums', 'peak_kb', 'log_bytes')
+    print('  '.join(f'{column:>16}' for column in columns))
+
+    for row in rows:
+        print('  '.join(f'{row[column]!s:>16}' for column in columns))
+
+
+# Returns a list of differences that count as regressions
+def compare(rows, baseline_rows, tolerance):
+    baseline = {row_key(row): row for row in baseline_rows}
+    regressions = []
+
+    for row in rows:
+        before = baseline.get(row_key(row))
+
+        if before is None:
+            print(f'{row_key(row)}: not in the baseline')
+            continue
+
+        for field in EXACT_FIELDS:
+            if row[field] != before[field]:
+                message = f'{row_key(row)} {field}: {before[field]} -> {row[field]}'
+                print(message)
+
+                if row[field] > before[field]:
+                    regressions.append(message)
+
+        for field in MEASURED_FIELDS:
+            if before[field] and row[field] > before[field] * (1 + tolerance):
+                message = f'{row_key(row)} {field}: {before[field]} -> {row[field]}'
+                print(message)
+                regressions.append(message)
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Connect pollers against local stand-ins')
+    parser.add_argument('--queues', default='10,100,1000,5000', help='comma delimited queue counts')
+    parser.add_argument('--handlers', default=','.join(HANDLERS), help='comma delimited handlers: ' + ', '.join(HANDLERS))
+    parser.add_argument('--latency', type=float, default=20, help='milliseconds added to every stand-in API call')
+    parser.add_argument('--save', help='write the results to this baseline file')
+    parser.add_argument('--compare', help='compare the results with this baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed rise of wall_ms, peak_kb and log_bytes against the baseline')
+    args = parser.parse_args(argv)
+
+    # No real AWS calls are made, but boto3 wants a region to build clients
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    rows = []
+
+    with tempfile.TemporaryDirectory() as state_directory:
+        for name in args.handlers.split(','):
+            for queue_count in args.queues.split(','):
+                rows.extend(run_scenario(name.strip(), int(queue_count), args.latency / 1000, state_directory))
+
+    print_rows(rows)
+
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump({'latency_ms': args.latency, 'results': rows}, baseline_file, indent=2)
+            baseline_file.write('\n')
+
+        print(f'Saved baseline to {args.save}')
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+
+        if baseline['latency_ms'] != args.latency:
+            print(f"The baseline was taken with --latency {baseline['latency_ms']}, wall times are not comparable")
+
+        regressions = compare(rows, baseline['results'], args.tolerance)
+
+        if regressions:
+            print(f'{len(regressions)} regressions against {args.compare}')
+            return 1
+
+        print(f'No regressions against {args.compare}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
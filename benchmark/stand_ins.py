@@ -0,0 +1,120 @@
+# Description: Local stand-ins for the Amazon Connect and CloudWatch clients
+# used by the benchmark. They answer the calls the pollers make with synthetic
+# but deterministic data, count every call, and can add a fixed latency per
+# call to model the network round trip.
+
+# Import relevant modules
+import threading
+import time
+import zlib
+
+
+class StandInClient:
+
+    def __init__(self, service, latency_seconds=0):
+        self.service = service
+        self.latency_seconds = latency_seconds
+
+        self._lock = threading.Lock()
+        self.calls = {}
+
+    def _call(self, operation):
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+
+    def call_count(self):
+        return sum(self.calls.values())
+
+
+class StandInConnect(StandInClient):
+
+    def __init__(self, queue_count, latency_seconds=0):
+        super().__init__('connect', latency_seconds)
+        self.queue_ids = [f'bench-queue-{index:05d}' for index in range(queue_count)]
+
+    def list_queues(self, InstanceId, QueueTypes=None, MaxResults=100, NextToken=None):
+        self._call('list_queues')
+
+        start = int(NextToken or 0)
+        end = min(start + MaxResults, len(self.queue_ids))
+
+        response = {
+            'QueueSummaryList': [
+                {'Id': queue_id, 'Arn': self._arn(InstanceId, queue_id), 'Name': f'Queue {queue_id[-5:]}', 'QueueType': 'STANDARD'}
+                for queue_id in self.queue_ids[start:end]
+            ]
+        }
+
+        if end < len(self.queue_ids):
+            response['NextToken'] = str(end)
+
+        return response
+
+    def get_metric_data(self, **kwargs):
+        self._call('get_metric_data')
+        return self._metric_results(kwargs, kwargs['HistoricalMetrics'])
+
+    def get_current_metric_data(self, **kwargs):
+        self._call('get_current_metric_data')
+        return self._metric_results(kwargs, kwargs['CurrentMetrics'])
+
+    def _arn(self, instance_id, queue_id):
+        return f'arn:aws:connect:us-east-1:123456789012:instance/{instance_id}/queue/{queue_id}'
+
+    def _metric_results(self, kwargs, metrics):
+        queue_ids = kwargs['Filters']['Queues']
+
+        # The real API rejects more than 100 queues per request
+        if len(queue_ids) > 100:
+            raise ValueError(f'{len(queue_ids)} queues in one request')
+
+        start = int(kwargs.get('NextToken') or 0)
+        end = min(start + kwargs.get('MaxResults', 100), len(queue_ids))
+        window = str(kwargs.get('StartTime', '')) + str(kwargs.get('EndTime', ''))
+
+        response = {
+            'MetricResults': [
+                {
+                    'Dimensions': {'Queue': {'Id': queue_id, 'Arn': self._arn(kwargs['InstanceId'], queue_id)}},
+                    'Collections': [
+                        {'Metric': {'Name': metric['Name'], 'Unit': metric['Unit']}, 'Value': float(zlib.crc32((queue_id + metric['Name'] + window).encode()) % 20)}
+                        for metric in metrics
+                    ]
+                }
+                for queue_id in queue_ids[start:end]
+            ]
+        }
+
+        if end < len(queue_ids):
+            response['NextToken'] = str(end)
+
+        return response
+
+
+class StandInCloudWatch(StandInClient):
+
+    def __init__(self, latency_seconds=0):
+        super().__init__('cloudwatch', latency_seconds)
+        self.datum_count = 0
+
+    def put_metric_data(self, Namespace, MetricData):
+        self._call('put_metric_data')
+
+        # Same limit as the real API
+        if len(MetricData) > 1000:
+            raise ValueError(f'{len(MetricData)} entries in one request')
+
+        with self._lock:
+            self.datum_count += len(MetricData)
+
+
+class StandInContext:
+
+    def __init__(self, timeout_seconds=60):
+        self.deadline = time.monotonic() + timeout_seconds
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
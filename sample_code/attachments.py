@@ -0,0 +1,149 @@
+# Description: Report attachments for the distributor. The size of the S3
+# object is checked before anything is read, so a report that could never fit
+# in an SES email is rejected without loading it. Reports above
+# attachment_compress_above bytes are gzip or zip compressed while they are
+# streamed from S3, so that only the compressed copy is held in memory, and
+# the compression stops as soon as its output would no longer fit. The email
+# is serialized to bytes in one pass with every attachment base64 encoded
+# straight into the output, instead of being held encoded in the message and
+# copied again by the email package's generator.
+# Environment variables are listed in sample_readme/daily_reports_distributor.txt
+
+# Import relevant modules
+import base64
+import gzip
+import io
+import uuid
+import zipfile
+from report_digest import SES_MAX_MESSAGE_BYTES, MESSAGE_OVERHEAD_BYTES, ATTACHMENT_OVERHEAD_BYTES
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+# Bytes base64 encoded at a time, whole 57 byte lines of 76 characters
+BASE64_CHUNK_SIZE = 57 * 16 * 1024
+
+# Archives with a member above this size need the zip64 extensions
+ZIP64_LIMIT = 2 ** 31 - 1
+
+
+class AttachmentTooLarge(Exception):
+    pass
+
+
+# Largest file that still fits in an email on its own once base64 encoded,
+# the inverse of report_digest.encoded_size
+def max_attachment_bytes(max_message_bytes=SES_MAX_MESSAGE_BYTES):
+    return (max_message_bytes - MESSAGE_OVERHEAD_BYTES - ATTACHMENT_OVERHEAD_BYTES) * 3 * 76 // (4 * 78)
+
+
+# Size of data once base64 encoded in lines of 76 characters, each ending in
+# a newline as the email package writes them
+def base64_size(size):
+    encoded_size = (size + 2) // 3 * 4
+
+    return encoded_size + (encoded_size + 75) // 76
+
+
+# In-memory file that refuses to grow beyond max_bytes
+class _CappedBuffer(io.BytesIO):
+
+    def __init__(self, filename, max_bytes):
+        super().__init__()
+        self.filename = filename
+        self.max_bytes = max_bytes
+
+    def write(self, data):
+        if self.tell() + len(data) > self.max_bytes:
+            raise AttachmentTooLarge(f'{self.filename} is more than {self.max_bytes} bytes even when compressed')
+
+        return super().write(data)
+
+
+def _copy(body, target):
+    for chunk in iter(lambda: body.read(READ_CHUNK_SIZE), b''):
+        target.write(chunk)
+
+
+# Reads an S3 object body into an attachment; returns (filename, data,
+# subtype), the subtype is None for an uncompressed file
+def read_attachment(body, content_length, filename, compression='off', compress_above=0, max_bytes=None):
+    max_bytes = max_attachment_bytes() if max_bytes is None else max_bytes
+
+    if compression == 'off' or content_length <= compress_above:
+        if content_length > max_bytes:
+            # Release the connection without downloading the object
+            body.close()
+            raise AttachmentTooLarge(f'{filename} is {content_length} bytes, more than the {max_bytes} that fit in an email')
+
+        return filename, body.read(), None
+
+    buffer = _CappedBuffer(filename, max_bytes)
+
+    # The connection is released even when the compression stops halfway
+    try:
+        if compression == 'gzip':
+            with gzip.GzipFile(filename=filename, mode='wb', fileobj=buffer, mtime=0) as archive:
+                _copy(body, archive)
+
+            return filename + '.gz', buffer.getvalue(), 'gzip'
+
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            with archive.open(filename, 'w', force_zip64=content_length > ZIP64_LIMIT) as member:
+                _copy(body, member)
+
+        return filename + '.zip', buffer.getvalue(), 'zip'
+
+    finally:
+        body.close()
+
+
+# A MIME part for an attachment whose data is only encoded when the message
+# is serialized; returns the part and the placeholder that stands in for the
+# data until then
+def attachment_part(filename, subtype=None):
+    from email.mime.application import MIMEApplication
+
+    placeholder = uuid.uuid4().hex
+
+    part = MIMEApplication(b'', subtype or filename)
+    part.set_payload(placeholder)
+    part.add_header('Content-Disposition', 'attachment', filename=filename)
+
+    return part, placeholder
+
+
+def _write_base64(output, data):
+    view = memoryview(data)
+
+    for start in range(0, len(view), BASE64_CHUNK_SIZE):
+        output.write(base64.encodebytes(view[start:start + BASE64_CHUNK_SIZE]))
+
+
+# Serializes a message with attachment_part attachments to bytes in one pass;
+# payloads are (placeholder, data) pairs in the order the parts were attached.
+# A message larger than max_bytes is refused before it is written.
+def message_bytes(msg, payloads, max_bytes=SES_MAX_MESSAGE_BYTES):
+
+    # Headers, bodies and boundaries, with the placeholders in place of the
+    # attachments; small whatever the size of the reports
+    rest = msg.as_bytes()
+    pieces = []
+
+    for placeholder, data in payloads:
+        before, rest = rest.split(placeholder.encode('ascii'), 1)
+        pieces.append((before, data))
+
+    size = sum(len(before) + base64_size(len(data)) for before, data in pieces) + len(rest)
+
+    if size > max_bytes:
+        raise AttachmentTooLarge(f'Message is {size} bytes, more than the {max_bytes} SES accepts')
+
+    output = io.BytesIO()
+
+    for before, data in pieces:
+        output.write(before)
+        _write_base64(output, data)
+
+    output.write(rest)
+
+    return output.getvalue()
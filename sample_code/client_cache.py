@@ -0,0 +1,114 @@
+# Description: Shared boto3 client registry for the sample handlers. Clients
+# are created once per (service, region) the first time they are asked for and
+# are then reused for the rest of the container's life, so warm invocations do
+# not pay for a new TLS handshake or credential lookup.
+# Optional environment variables are listed in sample_readme/client_cache.txt
+
+# Import relevant modules
+import threading
+import boto3
+from botocore.config import Config
+from config import ClientConfig, load_config
+from tracing import tracer
+
+
+class ClientCache:
+
+    def __init__(self, max_pool_connections=10, tcp_keepalive=True, limiter=None):
+        # Every client is built from the same config so that the connection
+        # pool size and keepalive setting apply to all services
+        self.config = Config(
+            max_pool_connections=max_pool_connections,
+            tcp_keepalive=tcp_keepalive
+        )
+
+        # With a rate limiter every API call goes through its token buckets
+        # and retries, so botocore's own retries are turned off
+        self.limiter = limiter
+
+        if limiter:
+            self.config = self.config.merge(Config(retries={'mode': 'standard', 'total_max_attempts': 1}))
+
+        # boto3's default session is not thread safe, so keep our own session
+        # and only create clients while holding the lock
+        self._session = boto3.session.Session()
+        self._lock = threading.Lock()
+        self._clients = {}
+
+        # Cold = a client had to be created, warm = an existing one was reused
+        self.cold_count = 0
+        self.warm_count = 0
+
+    def get(self, service, region=None):
+        key = (service, region)
+
+        with self._lock:
+            client = self._clients.get(key)
+
+            if client is None:
+                client = self._session.client(service, region_name=region, config=self.config)
+
+                # Every call through the client shows up in the trace summary
+                tracer.instrument_client(client)
+
+                client = self._limit(service, client)
+                self._clients[key] = client
+                self.cold_count += 1
+
+            else:
+                self.warm_count += 1
+
+        return client
+
+    # Use a ready-made client for a service, e.g. a local stand-in
+    def register(self, service, client, region=None):
+        with self._lock:
+            self._clients[(service, region)] = self._limit(service, client)
+
+    # Call at the start of every invocation, so that the retries stop in time
+    # for the handler to finish
+    def start_invocation(self, context):
+        if self.limiter:
+            self.limiter.start_invocation(context)
+
+    def _limit(self, service, client):
+        if self.limiter is None:
+            return client
+
+        from rate_limiter import LimitedClient
+        return LimitedClient(client, service, self.limiter)
+
+    def stats(self):
+        stats = {
+            'clients': len(self._clients),
+            'cold': self.cold_count,
+            'warm': self.warm_count
+        }
+
+        if self.limiter:
+            stats['limiter'] = self.limiter.stats()
+
+        return stats
+
+
+def _limiter(config):
+    if config.rate_limiter != 'on':
+        return None
+
+    from rate_limiter import limiter_from_config
+    return limiter_from_config(config)
+
+
+# Parse and check the client options once per container; with a bad value the
+# clients are still built from the defaults, and every handler reports
+# client_config_error instead of running
+client_config, client_config_error = load_config(ClientConfig)
+client_config = client_config or ClientConfig()
+
+# Created at import so that the registry, and the rate limiter's buckets,
+# outlive each invocation and are shared by every thread of the container
+clients = ClientCache(
+    max_pool_connections=client_config.client_max_pool_connections,
+    tcp_keepalive=client_config.client_tcp_keepalive,
+    limiter=_limiter(client_config)
+)
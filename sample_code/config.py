@@ -0,0 +1,449 @@
+# Description: Typed configuration for the sample handlers. Each handler
+# parses its environment variables once, when the container starts, into a
+# frozen config object: values are split and converted, required keys are
+# checked, and placeholders that still start with REPLACE are rejected. A bad
+# configuration is therefore reported at cold start, before any record is
+# touched, instead of in the middle of a batch.
+
+# Import relevant modules
+import codecs
+import functools
+import json
+import os
+import re
+from dataclasses import asdict, dataclass, field
+
+# What the handlers return when the configuration is unusable
+CONFIGURE_STATUS = "FAIL - PLEASE CONFIGURE ENVIRONMENT VARIABLES"
+UPDATE_STATUS = "FAIL - PLEASE UPDATE ENVIRONMENT VARIABLES"
+
+# Options that are either on or off
+SWITCH_VALUES = ('on', 'off')
+
+# Collections the combined Connect poller can run
+POLLER_COLLECTIONS = ('realtime', 'daily', 'hourly')
+
+# How the daily Connect poller gets the day's totals
+DAILY_MODES = ('full', 'incremental')
+
+# How the hourly Connect poller gets the last hour
+HOURLY_MODES = ('full', 'rolling')
+
+# Where processed S3 records are remembered beyond one container's memory
+IDEMPOTENCY_BACKENDS = ('memory', 'sqlite', 'dynamodb')
+
+# Where the handlers publish their metrics
+METRIC_OUTPUTS = ('api', 'emf')
+
+# Change detection in front of the metric emitter
+DELTA_FILTER_MODES = ('off', 'on')
+
+# How the distributor groups reports into emails
+DIGEST_MODES = ('off', 'invocation', 'window')
+
+# Where reports wait in window mode: a JSON file local to the container, or a
+# DynamoDB table shared by every container
+DIGEST_BACKENDS = ('file', 'dynamodb')
+
+# How the distributor compresses large attachments
+ATTACHMENT_COMPRESSIONS = ('off', 'gzip', 'zip')
+
+
+class ConfigError(Exception):
+
+    def __init__(self, message, status=CONFIGURE_STATUS):
+        super().__init__(message)
+        self.status = status
+
+
+def _require(environ, key):
+    if key not in environ:
+        raise ConfigError(f"Environment variable {key} not configured")
+
+    value = environ[key]
+
+    # The sample values shipped with the function have not been changed
+    if value.startswith("REPLACE"):
+        raise ConfigError(f"Environment variable {key} not updated", UPDATE_STATUS)
+
+    return value
+
+
+def _optional_int(environ, key, default, minimum=1, maximum=None):
+    try:
+        value = int(environ.get(key, default))
+
+    except ValueError:
+        raise ConfigError(f"Environment variable {key} must be a whole number")
+
+    if value < minimum:
+        raise ConfigError(f"Environment variable {key} must be at least {minimum}")
+
+    if maximum is not None and value > maximum:
+        raise ConfigError(f"Environment variable {key} must be at most {maximum}")
+
+    return value
+
+
+def _optional_float(environ, key, default, minimum=0):
+    try:
+        value = float(environ.get(key, default))
+
+    except ValueError:
+        raise ConfigError(f"Environment variable {key} must be a number")
+
+    if value < minimum:
+        raise ConfigError(f"Environment variable {key} must be at least {minimum}")
+
+    return value
+
+
+def _choice(environ, key, default, choices):
+    value = environ.get(key, default).strip().lower()
+
+    if value not in choices:
+        raise ConfigError(f"Environment variable {key} must be one of {', '.join(choices)}")
+
+    return value
+
+
+def _charset(environ, key='charset'):
+    value = _require(environ, key)
+
+    try:
+        codecs.lookup(value)
+
+    except LookupError:
+        raise ConfigError(f"Environment variable {key} is not a known text encoding: {value}")
+
+    return value
+
+
+# Resolve a time zone name once per container, with the standard library's
+# zoneinfo where the zone database is available and dateutil otherwise
+@functools.lru_cache(maxsize=None)
+def resolve_timezone(name):
+    try:
+        from zoneinfo import ZoneInfo
+        return ZoneInfo(name)
+
+    # No zoneinfo (before Python 3.9), no zone database, or an unknown name
+    except (ImportError, KeyError, ValueError):
+        import dateutil.tz
+        zone = dateutil.tz.gettz(name)
+
+        if zone is None:
+            raise ConfigError(f"Unknown time zone: {name}")
+
+        return zone
+
+
+# Options of create_emitter in metric_emitter.py, shared by every handler
+# that publishes metrics
+def _emitter_options(environ, namespace):
+    return dict(
+        metric_output=_choice(environ, 'metric_output', 'api', METRIC_OUTPUTS),
+        metric_publish_workers=_optional_int(environ, 'metric_publish_workers', '2', minimum=0),
+        delta_filter=_choice(environ, 'delta_filter', 'off', DELTA_FILTER_MODES),
+        delta_heartbeat=_optional_int(environ, 'delta_heartbeat', '12'),
+        delta_state_path=environ.get('delta_state_path', '/tmp/metric-delta-' + re.sub(r'[^A-Za-z0-9_.-]', '_', namespace) + '.json')
+    )
+
+
+# JSON object of service.method to [requests per second, burst], e.g.
+# {"connect.get_metric_data": [10, 15]}
+def _rate_limits(environ, key='rate_limits'):
+    try:
+        limits = json.loads(environ.get(key, '{}'))
+
+    except ValueError:
+        raise ConfigError(f"Environment variable {key} is not valid JSON")
+
+    if not isinstance(limits, dict):
+        raise ConfigError(f"Environment variable {key} must be a JSON object")
+
+    for name, limit in limits.items():
+        numbers = isinstance(limit, list) and len(limit) == 2 and all(
+            isinstance(value, (int, float)) and not isinstance(value, bool) for value in limit
+        )
+
+        if not numbers or limit[0] <= 0 or limit[1] < 1:
+            raise ConfigError(f"Environment variable {key} needs [requests per second above 0, burst of at least 1] for {name}")
+
+    return {name: tuple(limit) for name, limit in limits.items()}
+
+
+# Options of idempotency_store in idempotency.py, shared by the handlers
+# that process S3 records
+def _idempotency_options(environ):
+    backend = _choice(environ, 'idempotency_backend', 'memory', IDEMPOTENCY_BACKENDS)
+
+    return dict(
+        idempotency_backend=backend,
+        idempotency_table=_require(environ, 'idempotency_table') if backend == 'dynamodb' else '',
+        idempotency_path=environ.get('idempotency_path', '/tmp/idempotency.sqlite3'),
+        idempotency_ttl=_optional_int(environ, 'idempotency_ttl', '86400'),
+        idempotency_cache_size=_optional_int(environ, 'idempotency_cache_size', '1024')
+    )
+
+
+# Comma delimited list of addresses, empty entries dropped
+def _addresses(environ, key):
+    return tuple(address.strip() for address in _require(environ, key).split(",") if address.strip())
+
+
+# Shared by every handler through client_cache.py, with defaults for every
+# option
+@dataclass(frozen=True)
+class ClientConfig:
+    client_max_pool_connections: int = 10
+    client_tcp_keepalive: bool = True
+
+    # Token buckets and retries of rate_limiter.py, on unless turned off
+    rate_limiter: str = 'on'
+    rate_limits: dict = field(default_factory=dict)
+    retry_max_attempts: int = 5
+    retry_base_delay: float = 0.1
+    retry_max_delay: float = 5.0
+
+    @classmethod
+    def from_environ(cls, environ):
+        return cls(
+            client_max_pool_connections=_optional_int(environ, 'client_max_pool_connections', '10'),
+            client_tcp_keepalive=_choice(environ, 'client_tcp_keepalive', 'true', ('true', 'false')) == 'true',
+            rate_limiter=_choice(environ, 'rate_limiter', 'on', SWITCH_VALUES),
+            rate_limits=_rate_limits(environ),
+            retry_max_attempts=_optional_int(environ, 'retry_max_attempts', '5'),
+            retry_base_delay=_optional_float(environ, 'retry_base_delay', '0.1'),
+            retry_max_delay=_optional_float(environ, 'retry_max_delay', '5')
+        )
+
+
+@dataclass(frozen=True)
+class PollerConfig:
+    # Get from AWS Console > Amazon Connect > Overview > Instance ARN
+    connect_instance_id: str
+
+    # Only supported channel as of 6/4/20 is VOICE
+    channel_voice: str
+
+    # Only supported grouping as of 6/4/20 is QUEUE
+    grouping_queue: str
+
+    namespace: str
+
+    # Time zone for the timestamps and for the start of the day
+    timezone: str
+
+    # Queue id to name map, refreshed from list_queues after queue_cache_ttl
+    # seconds and kept in queue_cache_path between invocations
+    queue_cache_ttl: int = 300
+    queue_cache_path: str = ''
+
+    # Daily totals: fetched in full from midnight on every run, or added up
+    # incrementally from a checkpoint kept in daily_state_path
+    daily_mode: str = 'full'
+    daily_state_path: str = ''
+    daily_max_gap: int = 3600
+
+    # Hourly totals: fetched in full for the last hour on every run, or kept as
+    # a rolling window of five minute intervals in hourly_state_path
+    hourly_mode: str = 'full'
+    hourly_state_path: str = ''
+
+    # Metric output and change detection, see _emitter_options
+    metric_output: str = 'api'
+    metric_publish_workers: int = 2
+    delta_filter: str = 'off'
+    delta_heartbeat: int = 12
+    delta_state_path: str = ''
+
+    # Parallel fetch of the queue chunks, see metric_fetch.py; the APIs take at
+    # most 100 queues a request
+    fetch_max_workers: int = 4
+    fetch_chunk_size: int = 100
+    fetch_queue_size: int = 8
+
+    @classmethod
+    def from_environ(cls, environ):
+        connect_instance_id = _require(environ, 'connect_instance_id')
+        namespace = _require(environ, 'namespace')
+
+        config = cls(
+            connect_instance_id=connect_instance_id,
+            channel_voice=_require(environ, 'channel_voice'),
+            grouping_queue=_require(environ, 'grouping_queue'),
+            namespace=namespace,
+            timezone=environ.get('timezone', 'US/Central'),
+            queue_cache_ttl=_optional_int(environ, 'queue_cache_ttl', '300', minimum=0),
+            queue_cache_path=environ.get('queue_cache_path', f'/tmp/connect-queues-{connect_instance_id}.json'),
+            daily_mode=_choice(environ, 'daily_mode', 'full', DAILY_MODES),
+            daily_state_path=environ.get('daily_state_path', f'/tmp/connect-daily-{connect_instance_id}.json'),
+            daily_max_gap=_optional_int(environ, 'daily_max_gap', '3600'),
+            hourly_mode=_choice(environ, 'hourly_mode', 'full', HOURLY_MODES),
+            hourly_state_path=environ.get('hourly_state_path', f'/tmp/connect-hourly-{connect_instance_id}.json'),
+            fetch_max_workers=_optional_int(environ, 'fetch_max_workers', '4'),
+            fetch_chunk_size=_optional_int(environ, 'fetch_chunk_size', '100', maximum=100),
+            fetch_queue_size=_optional_int(environ, 'fetch_queue_size', '8'),
+            **_emitter_options(environ, namespace)
+        )
+
+        # Fails at cold start for an unknown zone, and caches the known one
+        resolve_timezone(config.timezone)
+
+        return config
+
+
+@dataclass(frozen=True)
+class RealtimePollerConfig(PollerConfig):
+    # Seconds between samples within one invocation, 0 for a single sample
+    sample_interval: int = 0
+
+    # Seconds to keep sampling for, usually the schedule of the function
+    sample_window: int = 60
+
+    # Milliseconds of the invocation left over for publishing the samples
+    sample_reserve: int = 5000
+
+    @classmethod
+    def from_environ(cls, environ):
+        return cls(
+            **asdict(PollerConfig.from_environ(environ)),
+            sample_interval=_optional_int(environ, 'sample_interval', '0', minimum=0),
+            sample_window=_optional_int(environ, 'sample_window', '60'),
+            sample_reserve=_optional_int(environ, 'sample_reserve', '5000', minimum=0)
+        )
+
+
+@dataclass(frozen=True)
+class CombinedPollerConfig(PollerConfig):
+    # Comma delimited subset of POLLER_COLLECTIONS, all of them by default
+    collections: tuple = POLLER_COLLECTIONS
+
+    @classmethod
+    def from_environ(cls, environ):
+        collections = tuple(
+            name.strip().lower() for name in environ.get('collections', ','.join(POLLER_COLLECTIONS)).split(",") if name.strip()
+        )
+
+        if not collections:
+            raise ConfigError("Environment variable collections has no collections")
+
+        for name in collections:
+            if name not in POLLER_COLLECTIONS:
+                raise ConfigError(f"Environment variable collections has an unknown collection: {name}")
+
+        # Drop repeats, keep the order
+        collections = tuple(dict.fromkeys(collections))
+
+        return cls(**asdict(PollerConfig.from_environ(environ)), collections=collections)
+
+
+@dataclass(frozen=True)
+class IdleTimeConfig:
+    path: str
+    region: str
+    bucket_name: str
+    charset: str
+    namespace: str
+
+    # Metric output and change detection, see _emitter_options
+    metric_output: str = 'api'
+    metric_publish_workers: int = 2
+    delta_filter: str = 'off'
+    delta_heartbeat: int = 12
+    delta_state_path: str = ''
+
+    # Duplicate S3 deliveries, see _idempotency_options
+    idempotency_backend: str = 'memory'
+    idempotency_table: str = ''
+    idempotency_path: str = ''
+    idempotency_ttl: int = 86400
+    idempotency_cache_size: int = 1024
+
+    @classmethod
+    def from_environ(cls, environ):
+        namespace = _require(environ, 'namespace')
+
+        return cls(
+            path=_require(environ, 'path'),
+            region=_require(environ, 'region'),
+            bucket_name=_require(environ, 'bucket_name'),
+            charset=_charset(environ),
+            namespace=namespace,
+            **_emitter_options(environ, namespace),
+            **_idempotency_options(environ)
+        )
+
+
+@dataclass(frozen=True)
+class DistributorConfig:
+    path: str
+    region: str
+    sender: str
+    recipient_default: tuple
+    cc_default: tuple
+    bucket_name: str
+    subject: str
+    charset: str
+    return_path: str
+    reply_to: str
+    max_workers: int
+    digest_mode: str
+    digest_window: int
+    digest_path: str
+    digest_backend: str
+    digest_table: str
+    digest_max_bytes: int
+    attachment_compression: str
+    attachment_compress_above: int
+
+    # Duplicate S3 deliveries, see _idempotency_options
+    idempotency_backend: str = 'memory'
+    idempotency_table: str = ''
+    idempotency_path: str = ''
+    idempotency_ttl: int = 86400
+    idempotency_cache_size: int = 1024
+
+    @classmethod
+    def from_environ(cls, environ):
+        digest_backend = _choice(environ, 'digest_backend', 'file', DIGEST_BACKENDS)
+
+        config = cls(
+            path=_require(environ, 'path'),
+            region=_require(environ, 'region'),
+            sender=_require(environ, 'sender'),
+            recipient_default=_addresses(environ, 'recipient_default'),
+            cc_default=_addresses(environ, 'cc_default'),
+            bucket_name=_require(environ, 'bucket_name'),
+            subject=_require(environ, 'subject'),
+            charset=_charset(environ),
+            return_path=_require(environ, 'return_path'),
+            reply_to=_require(environ, 'reply_to'),
+            max_workers=_optional_int(environ, 'max_workers', '1'),
+            digest_mode=_choice(environ, 'digest_mode', 'off', DIGEST_MODES),
+            digest_window=_optional_int(environ, 'digest_window', '60', minimum=0),
+            digest_path=environ.get('digest_path', '/tmp/report-digest.json'),
+            digest_backend=digest_backend,
+            digest_table=_require(environ, 'digest_table') if digest_backend == 'dynamodb' else '',
+            digest_max_bytes=_optional_int(environ, 'digest_max_bytes', '10485760', minimum=1048576),
+            attachment_compression=_choice(environ, 'attachment_compression', 'zip', ATTACHMENT_COMPRESSIONS),
+            attachment_compress_above=_optional_int(environ, 'attachment_compress_above', '5242880', minimum=0),
+            **_idempotency_options(environ)
+        )
+
+        if not config.recipient_default:
+            raise ConfigError("Environment variable recipient_default has no addresses")
+
+        return config
+
+
+# Parse the config for a handler, returns (config, None) or (None, error) so
+# that the handler can report the problem on every invocation without retrying
+def load_config(config_class, environ=os.environ):
+    try:
+        return config_class.from_environ(environ), None
+
+    except ConfigError as e:
+        print(f"Configuration error: {e}")
+        return None, e
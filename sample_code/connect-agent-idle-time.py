@@ -1,116 +1,247 @@
 # Description: Sample function to parse the incoming event from an S3 put, grab
 # the filename, open the file, and put into CloudWatch.
+# The function can also sit behind an SQS queue that receives the S3
+# notifications (enable ReportBatchItemFailures on the event source mapping):
+# every message can carry several reports, and only the messages whose
+# reports failed are returned in batchItemFailures to be delivered again.
 # Make sure to define the environment variables
 
 # Import relevant modules
-import os
-import boto3
-import dateutil.tz
+import json
 from urllib.parse import unquote_plus
-from datetime import datetime
+from datetime import datetime, timedelta
+from client_cache import clients, client_config_error
+from config import IdleTimeConfig, load_config, resolve_timezone
+from metric_emitter import create_emitter
+from csv_stream import iter_report_rows, parse_number
+from idempotency import record_key, idempotency_store
+from tracing import traced, traced_handler
+from logger import logger
 
-def lambda_handler(event, context):
+# Parse and check the environment variables once per container
+config, config_error = load_config(IdleTimeConfig)
 
-    # Extract the records from the incoming event
-    records = event['Records']
+# A bad client or rate limiter option of client_cache.py is reported the same way
+config_error = config_error or client_config_error
 
-    # Log the incoming event
-    print(event)
+# The report timestamps are in US/Central, resolved once per container
+central = resolve_timezone('US/Central')
 
-    # Iterate for each event in the stream
-    for i in records:
-        
-        # Log each record
-        print(i)
+# Records already processed by this container (or by any container, with a
+# persistent backend)
+idempotency = idempotency_store(config) if config else None
 
-        # Grab all of our environment variables and assign them to local vars
-        try:
-            path = os.environ['path']
-            aws_region = os.environ['region']
-            bucket_name = os.environ['bucket_name']
-            charset = os.environ['charset']
-            namespace = os.environ['namespace']
-
-        # One of more of the environment variables did not exist
-        except:
-            print("Environment variables not configured")
-            return("FAIL - PLEASE CONFIGURE ENVIRONMENT VARIABLES")
-            
-        # Start by extracting the file name (we use it later anyway)
-        filename = i['s3']['object']['key']
-        # Then decode it since it will likely contain a few :s
-        s3_filename = unquote_plus(filename)
-
-        # clean up filename and path for copmarison
-        sanitized_filename = filename.lower()
-        sanitized_path = path.lower()
-        
-        # Check the path to make sure that this is a Report
-        if not sanitized_filename.startswith(sanitized_path):
-            return('Not a report')
-
-        else: 
-            # Create a new S3 resource and specify a region
-            s3 = boto3.client('s3', aws_region)
-            
-            # Get the attachment from the S3 bucket      
-            s3_object = s3.get_object(Bucket=bucket_name, Key=s3_filename)
 
-            # Load the file into memory so that we can attach it
-            s3_record = s3_object['Body'].read()
-            s3_record_string = s3_record.decode(charset)
-            
-            # Start CSV reading and parsing code
-            s3_record_lines = s3_record_string.strip().split("\n")[2:]
-            
-            # Start cloudwatch code
-            cloudwatch = boto3.client('cloudwatch')
+# Every row of a report gets the time S3 received it, the same for every
+# delivery of the record; CloudWatch does not accept data older than two
+# weeks, so a replayed test event gets the current time
+def report_datetime(i):
+    now = datetime.now(tz=central)
+
+    if 'eventTime' not in i:
+        return now
+
+    event_datetime = datetime.fromisoformat(i['eventTime'].replace('Z', '+00:00')).astimezone(central)
+
+    if now - event_datetime > timedelta(days=14):
+        return now
+
+    return event_datetime
+
+
+# Read one report from S3 and put its rows into cloudwatch. Once part of the
+# report is published the record counts as processed, as a redelivery would
+# add those metrics a second time; raises only when nothing was published
+@traced('publish_report')
+def publish_report(s3_filename, current_datetime):
+    # Get the cached S3 client for the region
+    s3 = clients.get('s3', config.region)
+    
+    # Get the attachment from the S3 bucket      
+    s3_object = s3.get_object(Bucket=config.bucket_name, Key=s3_filename)
+
+    # Stream the report and parse it one row at a time, so that memory
+    # use stays flat however large the export is; rows that do not convert
+    # are skipped and counted instead of failing the report halfway
+    bad_rows = []
+    s3_record_rows = iter_report_rows(s3_object['Body'], config.charset, (str, parse_number, parse_number), bad_rows)
+    
+    # Start cloudwatch code, through PutMetricData or as Embedded Metric
+    # Format log lines depending on metric_output
+    emitter = create_emitter(config)
+    error = None
+    
+    # Put the report data into cloudwatch
+    try:
+        for team_lead, agent_idle_time, contacts_handled in s3_record_rows:
             
-            # Put the report data into cloudwatch
-            for item in s3_record_lines:
-                item_split = item.split(",")
-                
-                # Parse the csv line
-                team_lead = item_split[0]
-                agent_idle_time = item_split[1]
-                contacts_handled = item_split[2]
-                
-                central = dateutil.tz.gettz('US/Central')
-                current_datetime = datetime.now(tz=central)
-                
-                # Send the data to cloudwatch
-                cloudwatch.put_metric_data(
-                    Namespace=namespace,
-                    MetricData=[
+            # Queue the data for cloudwatch, it is sent in large batches
+            emitter.add_all([
+                {
+                    'MetricName': 'Agent Idle Time Per Team Lead',
+                    'Dimensions': [
                         {
-                            'MetricName': 'Agent Idle Time Per Team Lead',
-                            'Dimensions': [
-                                {
-                                    'Name': 'Team Lead',
-                                    'Value': team_lead
-                                }
-                            ],
-                            'Timestamp': current_datetime,
-                            'Value': int(agent_idle_time),
-                            'Unit': 'None'
-                        }, 
+                            'Name': 'Team Lead',
+                            'Value': team_lead
+                        }
+                    ],
+                    'Timestamp': current_datetime,
+                    'Value': agent_idle_time,
+                    'Unit': 'None'
+                }, 
+                {
+                    'MetricName': 'Contacts Handled Per Team Lead',
+                    'Dimensions': [
                         {
-                            'MetricName': 'Contacts Handled Per Team Lead',
-                            'Dimensions': [
-                                {
-                                    'Name': 'Team Lead',
-                                    'Value': team_lead
-                                }
-                            ],
-                            'Timestamp': current_datetime,
-                            'Value': int(contacts_handled),
-                            'Unit': 'None'
+                            'Name': 'Team Lead',
+                            'Value': team_lead
                         }
-                    ]
-                )
+                    ],
+                    'Timestamp': current_datetime,
+                    'Value': contacts_handled,
+                    'Unit': 'None'
+                }
+            ])
+
+    # Reading the report failed partway
+    except Exception as e:
+        error = str(e)
+
+    # Send whatever is left in the buffer for this report, and wait for the
+    # publish workers, also after a failure
+    failures = emitter.flush()
+    stats = emitter.stats()
+    print(f'metric emitter: {stats}')
+
+    if bad_rows:
+        logger.warning(f'Skipped {len(bad_rows)} rows of {s3_filename} that do not convert, first at {bad_rows[0]}')
+
+    if failures and not error:
+        error = f'{len(failures)} metrics were not published: {failures[0][1]}'
+
+    if error:
+        # Nothing went out, a later delivery can try the whole report again
+        if not stats['sent']:
+            raise RuntimeError(f'{s3_filename} was not published: {error}')
+
+        logger.error(f'{s3_filename} was only partly published: {error}')
+
+
+# The S3 records of an event record: the record itself when S3 invoked the
+# function, or the S3 notification wrapped in an SQS message (sent straight
+# by S3, or through SNS)
+def s3_records(record):
+    if record.get('eventSource') != 'aws:sqs':
+        return [record]
+
+    body = json.loads(record['body'])
+
+    # Delivered through an SNS topic
+    if 'Records' not in body and 'Message' in body:
+        body = json.loads(body['Message'])
+
+    # s3:TestEvent, sent when the notification is configured, has no records
+    return body.get('Records', [])
+
+
+# Publish one report, unless it is not a report or was already published;
+# raises when the report could not be published
+def process_s3_record(i):
+
+    # Log each record
+    logger.info(f"Record {i['s3']['object']['key']}")
+    logger.debug('record', i)
+
+    # Start by extracting the file name (we use it later anyway)
+    filename = i['s3']['object']['key']
+    # Then decode it since it will likely contain a few :s
+    s3_filename = unquote_plus(filename)
+
+    # clean up filename and path for copmarison
+    sanitized_filename = filename.lower()
+    sanitized_path = config.path.lower()
+    
+    # Check the path to make sure that this is a Report, other objects are
+    # skipped without affecting the rest of the batch
+    if not sanitized_filename.startswith(sanitized_path):
+        print("Not a report")
+        return
+
+    # Skip S3 redeliveries of a report that was already published,
+    # before any S3 or CloudWatch call is made
+    idempotency_key = record_key(i)
+
+    if not idempotency.claim(idempotency_key):
+        print("Duplicate delivery, already processed")
+        return
+
+    try:
+        publish_report(s3_filename, report_datetime(i))
+
+    # Let a later delivery of the record try again
+    except Exception:
+        idempotency.release(idempotency_key)
+        raise
+
+    idempotency.complete(idempotency_key)
+
+
+# One trace summary line per invocation, with the time spent in each stage
+# and in each AWS call
+@traced_handler('connect-agent-idle-time')
+def lambda_handler(event, context):
+
+    # The configuration was rejected when the container started
+    if config_error:
+        return(config_error.status)
+
+    # Decide whether this invocation writes debug output
+    logger.start_invocation()
+
+    # Retry throttled calls only as long as the invocation has time left
+    clients.start_invocation(context)
+
+    # Extract the records from the incoming event
+    records = event['Records']
+
+    # Log the size of the incoming event, the event itself only at debug level
+    logger.info(f'Received {len(records)} records')
+    logger.debug('event', event)
+
+    # Messages whose reports failed, returned to SQS to be delivered again
+    batch_item_failures = []
+
+    # Number of records whose reports failed
+    failed = 0
+
+    # Iterate for each event in the stream, a failure only fails its own
+    # record so that the rest of the batch is still processed
+    for record in records:
+
+        try:
+            for i in s3_records(record):
+                process_s3_record(i)
+
+        except Exception as e:
+            logger.error(f'Record failed: {e}')
+            failed += 1
+
+            if record.get('eventSource') == 'aws:sqs':
+                batch_item_failures.append({'itemIdentifier': record['messageId']})
+
+    # Log the outcome for the entire process
+    print(f'Processed {len(records)} records, failed: {failed}')
+    print(f'client cache: {clients.stats()}')
+    print(f'idempotency: {idempotency.stats()}')
+
+    # SQS only retries the messages listed here
+    if records and records[0].get('eventSource') == 'aws:sqs':
+        return {'batchItemFailures': batch_item_failures}
 
-    # Log a success for the entire process
-    print('Successfully processed reports')
+    # S3 retries the whole event, the reports already published are then
+    # skipped as duplicates
+    if failed:
+        raise RuntimeError(f'{failed} of {len(records)} reports failed')
 
     # Return the response
-    return('Complete')
\ No newline at end of file
+    return('Complete')
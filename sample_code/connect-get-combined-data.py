@@ -0,0 +1,59 @@
+from client_cache import clients, client_config_error
+from config import CombinedPollerConfig, load_config
+from metric_emitter import create_emitter
+from tracing import span, traced_handler
+from logger import logger
+from connect_collections import poll_cycle, run_collections
+
+# Parse and check the environment variables once per container
+config, config_error = load_config(CombinedPollerConfig)
+
+# A bad client or rate limiter option of client_cache.py is reported the same way
+config_error = config_error or client_config_error
+
+# One trace summary line per invocation, with the time spent in each stage
+# and in each AWS call
+@traced_handler('connect-get-combined-data')
+def lambda_handler(event, context):
+    # The configuration was rejected when the container started
+    if config_error:
+        return(config_error.status)
+    
+    # Decide whether this invocation writes debug output
+    logger.start_invocation()
+    
+    # Retry throttled calls only as long as the invocation has time left
+    clients.start_invocation(context)
+    
+    # Publish through PutMetricData or as Embedded Metric Format log lines,
+    # depending on metric_output; what was already queued is also sent when
+    # a fetch fails halfway
+    with create_emitter(config) as emitter:
+        
+        # One queue directory, one set of clients and one rounded current time for
+        # every selected collection
+        cycle = poll_cycle(config, emitter)
+        
+        # Run the selected collections side by side; their metrics share the
+        # emitter and go out in the same batches
+        statuses = run_collections(cycle, config.collections)
+        print(f'collections: {statuses}')
+        
+        # Send whatever is left in the buffer
+        with span('flush'):
+            emitter.flush()
+    
+    # Let a queue list refresh started during the invocation finish, the
+    # container is frozen once the handler returns
+    with span('queue_refresh'):
+        cycle.queues.wait()
+    
+    print(f'metric emitter: {emitter.stats()}')
+    print(f'queue directory: {cycle.queues.stats()}')
+    print(f'client cache: {clients.stats()}')
+    
+    # Report a failure when any collection failed, with the status of each
+    if any(status != "Complete" for status in statuses.values()):
+        return({'status': "FAIL - ONE OR MORE COLLECTIONS FAILED", 'collections': statuses})
+    
+    return("Complete")
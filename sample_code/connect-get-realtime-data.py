@@ -1,145 +1,59 @@
-import json
-import os
-import boto3
-import math
-import dateutil.tz
-from botocore.exceptions import ClientError
-from datetime import datetime, time, timedelta
+from client_cache import clients, client_config_error
+from config import RealtimePollerConfig, load_config
+from metric_emitter import create_emitter
+from tracing import span, traced_handler
+from logger import logger
+from connect_collections import poll_cycle, collect_realtime, sample_realtime
 
+# Parse and check the environment variables once per container
+config, config_error = load_config(RealtimePollerConfig)
+
+# A bad client or rate limiter option of client_cache.py is reported the same way
+config_error = config_error or client_config_error
+
+# One trace summary line per invocation, with the time spent in each stage
+# and in each AWS call
+@traced_handler('connect-get-realtime-data')
 def lambda_handler(event, context):
-    try:
-        # Get from AWS Console > Amazon Connect > Overview > Instance ARN
-        connect_instance_id = os.environ['connect_instance_id']
-        
-        # Only supported channel as of 6/4/20 is VOICE
-        channel_voice = os.environ['channel_voice']
-        
-        # Only supported grouping as of 6/4/20 is QUEUE
-        grouping_queue = os.environ['grouping_queue']
-        
-        namespace = os.environ['namespace']
-    
-    except:
-        print("Environment variables not configured")
-        return("FAIL - PLEASE CONFIGURE ENVIRONMENT VARIABLES")
-    
-    connect = boto3.client('connect')
-    cloudwatch = boto3.client('cloudwatch')
-    
-    list_queues = connect.list_queues(InstanceId=connect_instance_id, QueueTypes=['STANDARD'])['QueueSummaryList']
-    
-    queue_id_to_name_dict = {}
-    queue_id_list = []
-    for i in list_queues:
-        queue_id = i['Id']
-        queue_name = i['Name']
-        queue_id_list.append(queue_id)
-        queue_id_to_name_dict[queue_id] = queue_name
-    
-    central = dateutil.tz.gettz('US/Central')
-    current_datetime = datetime.now(tz=central)
-    print(f'current_datetime: {current_datetime}')
-    
-    # Round down to the nearest 5 minutes to comply with EndTime parameter
-    current_datetime = current_datetime - timedelta(minutes=current_datetime.minute % 5, seconds=current_datetime.second, microseconds=current_datetime.microsecond)
-    
-    # Round timestamp to whole number
-    current_datetime_timestamp = math.floor(current_datetime.timestamp())
-    print(f'current_datetime_timestamp: {current_datetime_timestamp}')
-    
-    # Get the timestamp from midnight of today (00:00:00)
-    start_of_day_datetime = datetime(current_datetime.year, current_datetime.month, current_datetime.day)
-    start_of_day_timestamp = start_of_day_datetime.timestamp()
-    print(f'start_of_day_datetime: {start_of_day_datetime}')
-    print(f'start_of_day_timestamp: {start_of_day_timestamp}')
-    
-    connect_metric_data = connect.get_current_metric_data(
-       InstanceId=connect_instance_id,
-       Filters={ 
-          'Channels': [ channel_voice ],
-          'Queues': queue_id_list
-       },
-       Groupings=[ grouping_queue ],
-       CurrentMetrics=[ 
-          { 
-             'Name': 'AGENTS_ONLINE',
-             'Unit': 'COUNT'
-          },
-          {
-             'Name': 'AGENTS_ON_CALL',
-             'Unit': 'COUNT'
-          }
-       ]
-    )
+    # The configuration was rejected when the container started
+    if config_error:
+        return(config_error.status)
     
-    print(connect_metric_data)
+    # Decide whether this invocation writes debug output
+    logger.start_invocation()
     
-    # Get the results for each queue
-    metric_results = connect_metric_data['MetricResults']
+    # Retry throttled calls only as long as the invocation has time left
+    clients.start_invocation(context)
     
-    # Loop through each item to get queue-specific results
-    for item in metric_results:
+    # Publish through PutMetricData or as Embedded Metric Format log lines,
+    # depending on metric_output; what was already queued is also sent when
+    # a fetch fails halfway
+    with create_emitter(config) as emitter:
         
-        # Get the following metrics from the JSON response, if not found and -1 shows up, there was an error in retrieval
-        agents_online = -1
-        agents_on_call = -1
+        # Resolve the Connect client, the queue directory and the rounded current
+        # time, then fetch and queue the current agent metrics of every queue
+        cycle = poll_cycle(config, emitter)
         
-        for i in range(len(item['Collections'])):
-            
-            name = item['Collections'][i]['Metric']['Name']
-            value = item['Collections'][i]['Value']
+        # With sample_interval set, sample every few seconds until the window or
+        # the invocation's time runs out and publish the samples at 1 second
+        # resolution, otherwise take one sample
+        if config.sample_interval:
+            sample_realtime(cycle, config.sample_interval, config.sample_window, context.get_remaining_time_in_millis, config.sample_reserve)
         
-            if name == "AGENTS_ONLINE":
-                agents_online = value
-            
-            elif name == "AGENTS_ON_CALL":
-                agents_on_call = value
+        else:
+            collect_realtime(cycle)
         
-        # Publish Metrics to CloudWatch Logs under the specified Namespace
-        cloudwatch.put_metric_data(
-            Namespace=namespace,
-            MetricData=[
-                {
-                    'MetricName': 'Agents Online',
-                    'Dimensions': [
-                        {
-                            'Name': 'Id',
-                            'Value': item['Dimensions']['Queue']['Id']
-                        },
-                        {
-                            'Name': 'Arn',
-                            'Value': item['Dimensions']['Queue']['Arn']
-                        },
-                        {
-                            'Name': 'Queue Name',
-                            'Value': queue_id_to_name_dict[item['Dimensions']['Queue']['Id']]
-                        }
-                    ],
-                    'Timestamp': current_datetime,
-                    'Value': agents_online,
-                    'Unit': 'Count'
-                },
-                {
-                    'MetricName': 'Agents On Call',
-                    'Dimensions': [
-                        {
-                            'Name': 'Id',
-                            'Value': item['Dimensions']['Queue']['Id']
-                        },
-                        {
-                            'Name': 'Arn',
-                            'Value': item['Dimensions']['Queue']['Arn']
-                        },
-                        {
-                            'Name': 'Queue Name',
-                            'Value': queue_id_to_name_dict[item['Dimensions']['Queue']['Id']]
-                        }
-                    ],
-                    'Timestamp': current_datetime,
-                    'Value': agents_on_call,
-                    'Unit': 'Count'
-                }
-            ]
-        )
+        # Send whatever is left in the buffer
+        with span('flush'):
+            emitter.flush()
+    
+    # Let a queue list refresh started during the invocation finish, the
+    # container is frozen once the handler returns
+    with span('queue_refresh'):
+        cycle.queues.wait()
+    
+    print(f'metric emitter: {emitter.stats()}')
+    print(f'queue directory: {cycle.queues.stats()}')
+    print(f'client cache: {clients.stats()}')
     
     return("Complete")
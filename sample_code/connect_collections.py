@@ -0,0 +1,260 @@
+# Description: The realtime, daily and hourly collections of the Connect
+# pollers. A poll cycle resolves what every collection needs once, the Connect
+# client, the queue directory and the rounded current time, and each collection
+# fetches its metrics and queues them on the shared emitter. The single-purpose
+# handlers run one collection; connect-get-combined-data.py runs any subset of
+# them in one invocation, concurrently.
+
+# Import relevant modules
+import math
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from client_cache import clients
+from config import resolve_timezone
+from queue_directory import queue_directory
+from metric_fetch import fetch_metric_results
+from metric_registry import REALTIME_METRICS, DAILY_METRICS, HOURLY_METRICS, queue_dimensions
+from daily_accumulator import daily_accumulator
+from hourly_window import rolling_window
+from tracing import traced
+from logger import logger
+
+PollCycle = namedtuple('PollCycle', [
+    'config', 'connect', 'emitter', 'queues', 'queue_ids', 'current_datetime', 'current_datetime_timestamp'
+])
+
+
+@traced('poll_cycle')
+def poll_cycle(config, emitter):
+    # Reuse the clients cached by earlier invocations in this container
+    connect = clients.get('connect')
+
+    # Get every queue id from the directory cached for this container
+    queues = queue_directory(connect, config)
+
+    current_datetime = datetime.now(tz=resolve_timezone(config.timezone))
+    print(f'current_datetime: {current_datetime}')
+
+    # Round down to the nearest 5 minutes to comply with EndTime parameter
+    current_datetime = current_datetime - timedelta(minutes=current_datetime.minute % 5, seconds=current_datetime.second, microseconds=current_datetime.microsecond)
+
+    # Round timestamp to whole number
+    current_datetime_timestamp = math.floor(current_datetime.timestamp())
+    print(f'current_datetime_timestamp: {current_datetime_timestamp}')
+
+    return PollCycle(config, connect, emitter, queues, queues.queue_ids(), current_datetime, current_datetime_timestamp)
+
+
+# (queue id, queue arn, values) for every queue, from get_current_metric_data
+def _realtime_values(cycle):
+    config = cycle.config
+
+    # Fetch the metrics in chunks of queues that the API accepts, in parallel,
+    # and get the results for each queue as soon as its chunk is done
+    metric_results = fetch_metric_results(
+        cycle.connect.get_current_metric_data,
+        cycle.queue_ids,
+        max_workers=config.fetch_max_workers,
+        chunk_size=config.fetch_chunk_size,
+        queue_size=config.fetch_queue_size,
+        InstanceId=config.connect_instance_id,
+        Filters={
+            'Channels': [config.channel_voice]
+        },
+        Groupings=[config.grouping_queue],
+        CurrentMetrics=REALTIME_METRICS.current_metrics
+    )
+
+    # Get the metrics from the JSON response, if not found and -1 shows up, there was an error in retrieval
+    for item in metric_results:
+        yield item['Dimensions']['Queue']['Id'], item['Dimensions']['Queue']['Arn'], REALTIME_METRICS.decode(item)
+
+
+@traced('collect.realtime')
+def collect_realtime(cycle):
+    for queue_id, queue_arn, values in _realtime_values(cycle):
+        dimensions = queue_dimensions(queue_id, queue_arn, cycle.queues.name(queue_id))
+
+        # Queue the metrics for CloudWatch under the specified Namespace; they
+        # are sent together with the other queues' metrics in large batches
+        cycle.emitter.add_all(REALTIME_METRICS.datums(dimensions, values, cycle.current_datetime))
+
+
+# Take a realtime sample every interval_seconds for up to window_seconds, and
+# stop early when fewer than reserve_ms milliseconds of the invocation would be
+# left after the next sample, taking as long as the last one did; time_left_ms
+# is context.get_remaining_time_in_millis. The samples are kept in memory and
+# queued at the end as high resolution metrics stamped with the time of their
+# sample. Returns the number of samples taken
+@traced('sample.realtime')
+def sample_realtime(cycle, interval_seconds, window_seconds, time_left_ms, reserve_ms=5000):
+    timezone = cycle.current_datetime.tzinfo
+    window_end = time.monotonic() + window_seconds
+    next_sample = time.monotonic()
+    samples = []
+
+    while True:
+        sampled_at = datetime.now(tz=timezone)
+        started = time.monotonic()
+
+        try:
+            queue_values = list(_realtime_values(cycle))
+
+        # Out of time (the rate limiter's DeadlineExceeded) or out of retries
+        # for a later sample: publish the samples already taken
+        except Exception as e:
+            if not samples:
+                raise
+
+            logger.warning(f'Stopped sampling after {len(samples)} samples: {e}')
+            break
+
+        samples.append((sampled_at, queue_values))
+        duration = time.monotonic() - started
+
+        next_sample += interval_seconds
+        wait = max(next_sample - time.monotonic(), 0)
+
+        # The next sample has to start inside the window and finish before
+        # the reserve
+        if next_sample >= window_end or time_left_ms() - (wait + duration) * 1000 < reserve_ms:
+            break
+
+        time.sleep(wait)
+
+    print(f'realtime samples: {len(samples)}')
+
+    # The queue dimensions are the same for every sample
+    dimensions = {}
+
+    for sampled_at, queue_values in samples:
+        for queue_id, queue_arn, values in queue_values:
+            if queue_id not in dimensions:
+                dimensions[queue_id] = queue_dimensions(queue_id, queue_arn, cycle.queues.name(queue_id))
+
+            cycle.emitter.add_all(REALTIME_METRICS.datums(dimensions[queue_id], values, sampled_at, storage_resolution=1))
+
+    return len(samples)
+
+
+@traced('collect.daily')
+def collect_daily(cycle):
+    config = cycle.config
+
+    # Get the timestamp from local midnight of today (00:00:00)
+    start_of_day_datetime = cycle.current_datetime.replace(hour=0, minute=0, second=0, microsecond=0)
+    start_of_day_timestamp = math.floor(start_of_day_datetime.timestamp())
+    print(f'start_of_day_datetime: {start_of_day_datetime}')
+    print(f'start_of_day_timestamp: {start_of_day_timestamp}')
+
+    # Pick up today's running totals from the checkpoint in incremental mode,
+    # otherwise start again from midnight
+    accumulator = daily_accumulator(config)
+    start_timestamp = accumulator.resume(start_of_day_datetime.date().isoformat(), start_of_day_timestamp, cycle.current_datetime_timestamp)
+    print(f'start_timestamp: {start_timestamp}')
+
+    # Nothing new to fetch when the last run already covered this interval
+    metric_results = []
+
+    if start_timestamp < cycle.current_datetime_timestamp:
+        metric_results = fetch_metric_results(
+            cycle.connect.get_metric_data,
+            cycle.queue_ids,
+            max_workers=config.fetch_max_workers,
+            chunk_size=config.fetch_chunk_size,
+            queue_size=config.fetch_queue_size,
+            InstanceId=config.connect_instance_id,
+            StartTime=start_timestamp,
+            EndTime=cycle.current_datetime_timestamp,
+            Filters={
+                'Channels': [config.channel_voice]
+            },
+            Groupings=[config.grouping_queue],
+            HistoricalMetrics=DAILY_METRICS.historical_metrics
+        )
+
+    # Add this interval to each queue's total for the day
+    for item in metric_results:
+        accumulator.add(item['Dimensions']['Queue']['Id'], item['Dimensions']['Queue']['Arn'], DAILY_METRICS.decode(item))
+
+    # Checkpoint the totals so that the next run only fetches what is new
+    accumulator.save()
+
+    # Publish the day's totals for every queue, including queues that had no
+    # contacts in the newest interval; a metric that was not found defaults to 0
+    for queue_id, queue_arn, totals in accumulator.items():
+        dimensions = queue_dimensions(queue_id, queue_arn, cycle.queues.name(queue_id))
+        cycle.emitter.add_all(DAILY_METRICS.datums(dimensions, totals, cycle.current_datetime))
+
+
+@traced('collect.hourly')
+def collect_hourly(cycle):
+    config = cycle.config
+
+    # Work out which windows to fetch: the trailing hour in full mode, only the
+    # newest 5 minute bucket in rolling mode, plus the trailing hour until the
+    # buffer holds all of it
+    window = rolling_window(config)
+    windows = window.plan(cycle.current_datetime_timestamp)
+    print(f'windows: {windows}')
+
+    for window_start, window_end in windows:
+        metric_results = fetch_metric_results(
+            cycle.connect.get_metric_data,
+            cycle.queue_ids,
+            max_workers=config.fetch_max_workers,
+            chunk_size=config.fetch_chunk_size,
+            queue_size=config.fetch_queue_size,
+            InstanceId=config.connect_instance_id,
+            StartTime=window_start,
+            EndTime=window_end,
+            Filters={
+                'Channels': [config.channel_voice]
+            },
+            Groupings=[config.grouping_queue],
+            HistoricalMetrics=HOURLY_METRICS.historical_metrics
+        )
+
+        # Keep the metrics found for each queue in this window
+        for item in metric_results:
+            window.add(window_start, window_end, item['Dimensions']['Queue']['Id'], item['Dimensions']['Queue']['Arn'], HOURLY_METRICS.decode(item))
+
+    # Publish the trailing hour for every queue, if -1 shows up, there was either error in retrieval or no data found
+    for queue_id, queue_arn, sums in window.items():
+        dimensions = queue_dimensions(queue_id, queue_arn, cycle.queues.name(queue_id))
+        cycle.emitter.add_all(HOURLY_METRICS.datums(dimensions, sums, cycle.current_datetime))
+
+    # Checkpoint the buffer so that the next run only fetches the newest bucket
+    window.save()
+
+
+COLLECTIONS = {
+    'realtime': collect_realtime,
+    'daily': collect_daily,
+    'hourly': collect_hourly
+}
+
+
+def _run_collection(name, cycle):
+    try:
+        COLLECTIONS[name](cycle)
+
+    except Exception as e:
+        print(f"Collection {name} failed: {e}")
+        return "FAIL - " + str(e)
+
+    return "Complete"
+
+
+# Run the named collections on one poll cycle, at the same time when there is
+# more than one; a failed collection does not stop the others. Returns the
+# status of each collection by name
+def run_collections(cycle, names):
+    if len(names) == 1:
+        return {names[0]: _run_collection(names[0], cycle)}
+
+    with ThreadPoolExecutor(max_workers=len(names)) as executor:
+        statuses = executor.map(lambda name: _run_collection(name, cycle), names)
+        return dict(zip(names, statuses))
@@ -0,0 +1,143 @@
+# Description: Streaming CSV reader for report exports stored in S3. The
+# object body is read in fixed size chunks and decoded incrementally, so
+# memory use does not grow with the size of the report. Rows are parsed with
+# the csv module (quoted commas and newlines are handled), the preamble and
+# the header row are skipped, and every data row is yielded with its columns
+# converted to the requested types. A data row that does not convert raises,
+# or is skipped and recorded in bad_rows, wherever it is in the report.
+
+# Import relevant modules
+import codecs
+import csv
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+# Convert a report cell such as "1,234" or "12.5" into an int or a float
+def parse_number(cell):
+    cell = cell.strip().replace(',', '')
+
+    try:
+        return int(cell)
+
+    except ValueError:
+        return float(cell)
+
+
+# Yield the body one line at a time, line endings included as csv expects
+def iter_text_lines(body, charset, chunk_size=READ_CHUNK_SIZE):
+    decoder = codecs.getincrementaldecoder(charset)()
+    pending = ''
+    started = False
+
+    while True:
+        chunk = body.read(chunk_size)
+        text = decoder.decode(chunk, final=not chunk)
+
+        # Drop the byte order mark that Excel style exports start with
+        if not started and text:
+            text = text.lstrip('\ufeff')
+            started = True
+
+        lines = (pending + text).split('\n')
+
+        # The last piece is an incomplete line until the next chunk arrives
+        pending = lines.pop()
+
+        for line in lines:
+            yield line + '\n'
+
+        if not chunk:
+            break
+
+    if pending:
+        yield pending
+
+
+# The cells of a row without the empty ones that trailing commas leave
+def _cells(row):
+    cells = list(row)
+
+    while cells and not cells[-1].strip():
+        cells.pop()
+
+    return cells
+
+
+# A row can be converted with the column types, i.e. it is data, not a label
+def is_data_row(row, columns):
+    try:
+        convert_row(row, columns)
+        return True
+
+    except (ValueError, IndexError):
+        return False
+
+
+# The header row: one label per column, none of them a number
+def is_header_row(row, columns):
+    cells = _cells(row)
+
+    if len(cells) != len(columns):
+        return False
+
+    for cell in cells:
+        if not cell.strip():
+            return False
+
+        try:
+            parse_number(cell)
+            return False
+
+        except ValueError:
+            pass
+
+    return True
+
+
+def convert_row(row, columns):
+    if len(row) < len(columns):
+        raise IndexError(f'expected {len(columns)} columns, got {len(row)}')
+
+    return tuple(convert(cell) for convert, cell in zip(columns, row))
+
+
+# columns holds one converter per column, e.g. (str, parse_number). A data
+# row that does not convert raises ValueError, or with a bad_rows list is
+# appended to it (line number and error) and skipped.
+def iter_report_rows(body, charset, columns, bad_rows=None):
+    in_data = False
+    reader = csv.reader(iter_text_lines(body, charset))
+
+    for row in reader:
+
+        # Skip blank lines wherever they appear
+        if not any(cell.strip() for cell in row):
+            continue
+
+        # Title lines and report parameters come first and are skipped. The
+        # data starts after the header row, or in a report without one at the
+        # first row with a cell per column
+        if not in_data:
+            if is_header_row(row, columns):
+                in_data = True
+                continue
+
+            if len(columns) not in (len(row), len(_cells(row))) and not is_data_row(row, columns):
+                continue
+
+            in_data = True
+
+        try:
+            values = convert_row(row, columns)
+
+        except (ValueError, IndexError) as e:
+            error = f'line {reader.line_num}: {e}'
+
+            if bad_rows is None:
+                raise ValueError(f'Bad report row, {error}')
+
+            bad_rows.append(error)
+            continue
+
+        yield values
@@ -0,0 +1,80 @@
+# Description: Checkpointed running totals for the daily Connect poller. In
+# incremental mode each run only fetches the intervals closed since the last
+# checkpoint and adds them to the per-queue totals kept in /tmp (or any other
+# JSON file). The totals start again at local midnight, and the whole day is
+# fetched again when there is no usable checkpoint: none saved, from another
+# day, or older than daily_max_gap seconds. In full mode (the default) every
+# run fetches the whole day, as before.
+# Optional environment variables are listed in sample_readme/daily_accumulator.txt
+
+# Import relevant modules
+from state_store import JsonFileStore
+
+
+class DailyAccumulator:
+
+    def __init__(self, store, instance_id, incremental=False, max_gap_seconds=3600):
+        self.store = store
+        self.instance_id = instance_id
+        self.incremental = incremental
+        self.max_gap_seconds = max_gap_seconds
+
+        self.day = None
+        self.end_timestamp = None
+        self._queues = {}
+
+    # Returns the StartTime for this run's get_metric_data call
+    def resume(self, day, start_of_day_timestamp, end_timestamp):
+        state = self.store.load() if self.incremental else None
+
+        usable = (
+            state is not None
+            and state.get('instance_id') == self.instance_id
+            and state.get('day') == day
+            and start_of_day_timestamp <= state['end'] <= end_timestamp
+            and end_timestamp - state['end'] <= self.max_gap_seconds
+        )
+
+        self.day = day
+        self.end_timestamp = end_timestamp
+
+        if usable:
+            self._queues = state['queues']
+            print(f"Resuming daily totals from checkpoint at {state['end']}")
+            return state['end']
+
+        # Full recompute from midnight
+        self._queues = {}
+        return start_of_day_timestamp
+
+    # Add the values of one queue for the fetched interval to its total
+    def add(self, queue_id, queue_arn, values):
+        queue = self._queues.setdefault(queue_id, {'arn': queue_arn, 'totals': {}})
+        totals = queue['totals']
+
+        for name, value in values.items():
+            totals[name] = totals.get(name, 0) + value
+
+    # (queue id, queue arn, totals) for every queue with data today
+    def items(self):
+        for queue_id, queue in self._queues.items():
+            yield queue_id, queue['arn'], queue['totals']
+
+    def save(self):
+        self.store.save({
+            'instance_id': self.instance_id,
+            'day': self.day,
+            'end': self.end_timestamp,
+            'queues': self._queues
+        })
+
+
+# Built from the poller's config, where daily_mode, daily_state_path and
+# daily_max_gap are checked at cold start
+def daily_accumulator(config):
+    return DailyAccumulator(
+        JsonFileStore(config.daily_state_path),
+        config.connect_instance_id,
+        incremental=config.daily_mode == 'incremental',
+        max_gap_seconds=config.daily_max_gap
+    )
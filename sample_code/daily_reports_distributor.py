@@ -4,175 +4,438 @@
 # Make sure to define the environment variables
 
 # Import relevant modules
-import os
-import boto3
-import re
+import time
 from urllib.parse import unquote_plus
-from botocore.exceptions import ClientError
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
+from botocore.exceptions import BotoCoreError, ClientError
 from datetime import datetime
 from datetime import timedelta
-from csv import reader
+from concurrent.futures import ThreadPoolExecutor
+from client_cache import clients, client_config_error
+from config import DistributorConfig, ConfigError, load_config
+from report_router import load_router
+from report_digest import digest_buffer, plan_digests
+from attachments import AttachmentTooLarge, attachment_part, message_bytes, read_attachment
+from idempotency import record_key, idempotency_store
+from tracing import span, traced, traced_handler
+from logger import logger
 
+# Parse and check the environment variables and compile the routing rules once
+# per container, so a bad configuration shows up at cold start
+config, config_error = load_config(DistributorConfig)
+
+# A bad client or rate limiter option of client_cache.py is reported the same way
+config_error = config_error or client_config_error
+router = None
+
+if config:
+    try:
+        router = load_router(config.recipient_default, config.cc_default, s3=clients.get('s3', config.region))
+
+    # Malformed rules, a missing rules file or an S3 object that cannot be
+    # read are reported on every invocation instead of failing the import
+    except (KeyError, ValueError, TypeError, OSError, BotoCoreError, ClientError) as e:
+        print(f"Routing rules not configured: {e}")
+        config_error = ConfigError(f"Routing rules not configured: {e}")
+
+# Records already processed by this container (or by any container, with a
+# persistent backend)
+idempotency = idempotency_store(config) if config else None
+
+# Reports held back for a digest, in window mode only
+digests_buffer = digest_buffer(config) if config and config.digest_mode == 'window' else None
+
+
+# Check one record and claim it, nothing is read from S3 yet; returns the
+# result for a record that is skipped, or the report to send
+def prepare_record(i):
+
+    # Log each record
+    logger.info(f"Record {i['s3']['object']['key']}")
+    logger.debug('record', i)
+
+    # Start by extracting the file name (we use it later anyway)
+    filename = i['s3']['object']['key']
+    # Then decode it since it will likely contain a few :s
+    s3_filename = unquote_plus(filename)
+
+    # clean up filename and path for copmarison
+    sanitized_filename = filename.lower()
+    sanitized_path = config.path.lower()
+    
+    # Check the path to make sure that this is a Report
+    if not sanitized_filename.startswith(sanitized_path):
+        print("Not a report")
+        return {'key': filename, 'status': 'skipped'}
+
+    # Skip S3 redeliveries of a record that was already processed, before any
+    # S3 or SES call is made
+    idempotency_key = record_key(i)
+
+    if not idempotency.claim(idempotency_key):
+        print("Duplicate delivery, already processed")
+        return {'key': filename, 'status': 'duplicate'}
+
+    # Then check it against our routing rules, the matching rule with the
+    # highest priority wins and recipient_default/cc_default is the fallback
+    recipient, cc = router.route(sanitized_filename)
+
+    return {
+        'key': filename,
+        'status': 'pending',
+        's3_filename': s3_filename,
+        'idempotency_key': idempotency_key,
+        'recipient': list(recipient),
+        'cc': list(cc),
+        'size': i['s3']['object'].get('size', 0),
+        'received': time.time()
+    }
+
+
+# Mark the reports of one email done, or let a later delivery try them again;
+# returns the result for each report
+def finish_reports(reports, result):
+    results = []
+
+    for report in reports:
+        if result['status'] == 'sent':
+            idempotency.complete(report['idempotency_key'])
+
+        else:
+            idempotency.release(report['idempotency_key'])
+
+        results.append(dict(result, key=report['key']))
+
+    return results
+
+
+# Fetch one report from S3 and email it, returns the result for the record
+def process_record(i):
+    report = prepare_record(i)
+
+    if report['status'] != 'pending':
+        return report
+
+    try:
+        result = send_report(report['recipient'], report['cc'], [load_attachment(report)])
+
+    # Let a later delivery of the record try again
+    except Exception:
+        idempotency.release(report['idempotency_key'])
+        raise
+
+    return finish_reports([report], result)[0]
+
+
+# The day the reports cover, in the subject and the attachment names
+def report_date():
+    utc_date = datetime.now()
+    one_day = timedelta(days=1)
+    
+    ct_date = utc_date - one_day
+    return ct_date.strftime("%m.%d.%Y")
+
+
+# Get one report from the S3 bucket as an attachment, returns (filename,
+# data, subtype); a file that cannot fit in an email is rejected before it is
+# read
+def load_attachment(report, digest=False):
+
+    # Get the cached S3 client for the region, so that every record after the
+    # first reuses the same connections
+    s3 = clients.get('s3', config.region)
+
+    # Mod the filename so that we can attach it, the reports of a digest keep
+    # their own file names after the subject and date
+    formatted_date = report_date()
+    clean_filename = config.subject + " " + formatted_date + ".csv"
+
+    if digest:
+        clean_filename = config.subject + " " + formatted_date + " " + report['s3_filename'].rsplit('/', 1)[-1]
+
+    clean_filename = clean_filename.replace(" ", "_")
+
+    # Get the attachment from the S3 bucket      
+    s3_object = s3.get_object(Bucket=config.bucket_name, Key=report['s3_filename'])
+
+    # Load the file into memory so that we can attach it, compressed while
+    # it is read when it is above attachment_compress_above
+    with span('s3.read_body'):
+        return read_attachment(
+            s3_object['Body'],
+            s3_object['ContentLength'],
+            clean_filename,
+            config.attachment_compression,
+            config.attachment_compress_above
+        )
+
+
+# Build one email with the attachments, given as (filename, data, subtype),
+# and send it through SES to the recipients the reports were routed to
+@traced('send_report')
+def send_report(recipient, cc, attachments):
+
+    # Get the cached SES client for the region
+    ses = clients.get('ses', config.region)
+
+    # The email package is only loaded once there is a report to send, which
+    # keeps it off the cold start
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    
+    # Create a multipart/mixed parent container
+    msg = MIMEMultipart('mixed')
+
+    formatted_date = report_date()
+
+    # Add from, to, and subject lines
+    msg['From'] = config.sender 
+    msg['To'] = ', '.join(recipient)
+    msg['Cc'] = ', '.join(cc)
+    msg['Subject'] = config.subject + " " + formatted_date
+    
+    # A digest says how many reports it carries
+    if len(attachments) == 1:
+        notice = 'Your scheduled report is attached.'
+
+    else:
+        notice = f'Your {len(attachments)} scheduled reports are attached.'
+
+    # The email body for recipients with non-HTML email clients
+    body_text = 'Hello,\r\n' + notice
+    
+    # The HTML body of the email
+    body_html = f"""\
+    <html>
+    <head></head>
+    <body>
+    <h2>Notice:</h2>
+    <p>{notice}</p>
+    </body>
+    </html>
+    """
+    
+    # Create a multipart/alternative child container
+    msg_body = MIMEMultipart('alternative')
+    
+    # Encode the text and HTML content and set the character encoding
+    textpart = MIMEText(body_text.encode(config.charset), 'plain', config.charset)
+    htmlpart = MIMEText(body_html.encode(config.charset), 'html', config.charset)
+    
+    # Add the text and HTML parts to the child container
+    msg_body.attach(textpart)
+    msg_body.attach(htmlpart)
+
+    # Add the files and their headers to the email, the data itself is only
+    # encoded when the email is serialized
+    payloads = []
+
+    for clean_filename, attachment_body, subtype in attachments:
+        part, placeholder = attachment_part(clean_filename, subtype)
+        msg.attach(part)
+        payloads.append((placeholder, attachment_body))
+    
+    # Attach the multipart/alternative child container to the parent
+    msg.attach(msg_body)
+    msg.add_header('Return-Path', config.return_path)
+    msg.add_header('Reply-To', config.reply_to)
+    
+    # Serialize the whole message straight to bytes in one pass, which is
+    # what SES is sent; a message SES would refuse is not built at all
+    try:
+        with span('mime.serialize'):
+            raw_message = message_bytes(msg, payloads)
+
+    except AttachmentTooLarge as e:
+        print(e)
+        return {'status': 'failed', 'error': str(e)}
+
+    # Only the serialized copy is needed from here on
+    attachments.clear()
+    payloads.clear()
+    
+    # Send the email
+    try:
+        # Provide the contents of the email.
+        response = ses.send_raw_email(
+            Source=config.sender,
+            Destinations=recipient + cc,
+            RawMessage={
+                'Data':raw_message
+            }
+        )
+
+    # Display an error if something goes wrong
+    except ClientError as e:
+        print(e.response['Error']['Message'])
+        return {'status': 'failed', 'error': e.response['Error']['Message']}
+
+    # Otherwise log the success for this file
+    else:
+        print('Email sent! Message ID:'),
+        print(response['MessageId'])
+        return {'status': 'sent', 'message_id': response['MessageId']}
+
+
+# Any other error (e.g. the S3 GET failed) only fails this record
+def safe_process_record(i):
+    try:
+        return process_record(i)
+
+    except Exception as e:
+        print(f"Failed to process record: {e}")
+        return {'key': i['s3']['object']['key'], 'status': 'failed', 'error': str(e)}
+
+
+# Send one digest; a report that cannot be read only fails itself and any
+# other error fails the whole email. Returns (reports, result) pairs.
+def safe_send_digest(digest):
+    recipient, cc, reports = digest
+    attachments = []
+    attached = []
+    outcomes = []
+
+    for report in reports:
+        try:
+            attachments.append(load_attachment(report, digest=len(reports) > 1))
+            attached.append(report)
+
+        except Exception as e:
+            print(f"Failed to read report: {e}")
+            outcomes.append(([report], {'status': 'failed', 'error': str(e)}))
+
+    if attachments:
+        try:
+            result = send_report(recipient, cc, attachments)
+
+        except Exception as e:
+            print(f"Failed to send digest: {e}")
+            result = {'status': 'failed', 'error': str(e)}
+
+        outcomes.append((attached, result))
+
+    return outcomes
+
+
+# Digest mode: the reports for the same To and Cc addresses are sent as one
+# email, or as few as fit under the SES message size; returns the result for
+# every record in the order of the event, followed by those of reports that
+# earlier invocations left in the buffer
+def process_digests(records, max_workers):
+    results = []
+    reports = []
+
+    # Position of each pending report in the event
+    positions = {}
+
+    def position(report):
+        return positions.get(report['idempotency_key'], len(records))
+
+    # Check and claim every record first, reading nothing from S3
+    for index, i in enumerate(records):
+        try:
+            result = prepare_record(i)
+
+        except Exception as e:
+            print(f"Failed to process record: {e}")
+            result = {'key': i['s3']['object']['key'], 'status': 'failed', 'error': str(e)}
+
+        if result['status'] == 'pending':
+            positions[result['idempotency_key']] = index
+            reports.append(result)
+
+        else:
+            results.append((index, result))
+
+    # In window mode the reports wait for later reports to the same
+    # recipients, until the oldest of them has waited digest_window seconds
+    if digests_buffer:
+        due = digests_buffer.add_and_take_due(reports)
+        due_keys = {report['idempotency_key'] for report in due}
+
+        results += [(position(report), {'key': report['key'], 'status': 'buffered'}) for report in reports if report['idempotency_key'] not in due_keys]
+        reports = due
+
+    digests = plan_digests(reports, config.digest_max_bytes)
+    print(f"Sending {len(reports)} reports in {len(digests)} emails")
+
+    if max_workers > 1 and len(digests) > 1:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(digests))) as executor:
+            outcomes = [outcome for digest_outcomes in executor.map(safe_send_digest, digests) for outcome in digest_outcomes]
+
+    else:
+        outcomes = [outcome for digest in digests for outcome in safe_send_digest(digest)]
+
+    for reports, result in outcomes:
+
+        # Buffered reports are tried again at the next flush, until they run
+        # out of attempts
+        if result['status'] != 'sent' and digests_buffer:
+            dropped_keys = {report['idempotency_key'] for report in digests_buffer.put_back(reports)}
+
+            results += [(position(report), dict(result, key=report['key'], status='buffered')) for report in reports if report['idempotency_key'] not in dropped_keys]
+            reports = [report for report in reports if report['idempotency_key'] in dropped_keys]
+
+        results += zip([position(report) for report in reports], finish_reports(reports, result))
+
+    # Digests are planned by recipients and size, put the results back in the
+    # order of the records (sorted keeps the buffer's reports in their order)
+    return [result for index, result in sorted(results, key=lambda item: item[0])]
+
+
+# One trace summary line per invocation, with the time spent in each stage
+# and in each AWS call
+@traced_handler('daily_reports_distributor')
 def lambda_handler(event, context):
 
-    # Extract the records from the incoming event
-    records = event['Records']
+    # Decide whether this invocation writes debug output
+    logger.start_invocation()
+
+    # Retry throttled calls only as long as the invocation has time left
+    clients.start_invocation(context)
+
+    # Extract the records from the incoming event; a scheduled event has
+    # none and only sends the digests that are due
+    records = event.get('Records', [])
 
-    # Log the incoming event
-    print(event)
+    # Log the size of the incoming event, the event itself only at debug level
+    logger.info(f'Received {len(records)} records')
+    logger.debug('event', event)
+
+    # The configuration was rejected when the container started
+    if config_error:
+        return(config_error.status)
+
+    # Number of records processed at the same time, 1 keeps the original
+    # one-at-a-time behaviour
+    max_workers = config.max_workers
 
     # Iterate for each event in the stream
-    for i in records:
-        
-        # Log each record
-        print(i)
+    if config.digest_mode != 'off':
+        results = process_digests(records, max_workers)
 
-        # Grab all of our environment variables and assign them to local vars
-        try:
-            path = os.environ['path']
-            aws_region = os.environ['region']
-            sender = os.environ['sender']
-            group_1 = os.environ['key_1']
-            recipient_1 = os.environ['recipient_1'].split(",")
-            recipient_default = os.environ['recipient_default'].split(",")
-            cc_1 = os.environ['cc_1'].split(",")
-            cc_default = os.environ['cc_default'].split(",")
-            bucket_name = os.environ['bucket_name']
-            subject = os.environ['subject']
-            charset = os.environ['charset']
-            return_path = os.environ['return_path']
-            reply_to = os.environ['reply_to']
-
-        # One of more of the environment variables did not exist
-        except:
-            print("Environment variables not configured")
-            return("FAIL - PLEASE CONFIGURE ENVIRONMENT VARIABLES")
-
-        # Check to make sure that the environment defaults were changed
-        if path.startswith("REPLACE"):
-            print("Environment variables not updated")
-            return("FAIL - PLEASE UPDATE ENVIRONMENT VARIABLES")
-            
-        # Start by extracting the file name (we use it later anyway)
-        filename = i['s3']['object']['key']
-        # Then decode it since it will likely contain a few :s
-        s3_filename = unquote_plus(filename)
-
-        # clean up filename and path for copmarison
-        sanitized_filename = filename.lower()
-        sanitized_path = path.lower()
-        
-        # Check the path to make sure that this is a Report
-        if not sanitized_filename.startswith(sanitized_path):
-            print("Not a report")
-
-        else: 
-            
-            # Create a new SES resource and specify a region
-            ses = boto3.client('ses',region_name=aws_region)
-
-            # Create a new S3 resource and specify a region
-            s3 = boto3.client('s3', aws_region)
-
-            # Then check it against our defined options
-            # Create references for each group and drop them to lower case, so 
-            # that we get a good comparison
-            clean_group_1 = group_1.lower()
-
-            if clean_group_1 in sanitized_filename: 
-                recipient = recipient_1
-                cc = cc_1
-            
-            # Iterate elif statements for additional distros
-            else:
-                recipient = recipient_default
-                cc = cc_default
-            
-            # Create a multipart/mixed parent container
-            msg = MIMEMultipart('mixed')
-
-            utc_date = datetime.now()
-            one_day = timedelta(days=1)
-            
-            ct_date = utc_date - one_day
-            formatted_date = ct_date.strftime("%m.%d.%Y")
-
-            # Add from, to, and subject lines
-            msg['From'] = sender 
-            msg['To'] = ', '.join(recipient)
-            msg['Cc'] = ', '.join(cc)
-            msg['Subject'] = subject + " " + formatted_date
-            
-            # Get the attachment from the S3 bucket      
-            s3_object = s3.get_object(Bucket=bucket_name, Key=s3_filename)
-
-            # Load the file into memory so that we can attach it
-            attachment_body = s3_object['Body'].read()
-            
-            # The email body for recipients with non-HTML email clients
-            body_text = 'Hello,\r\nYour scheduled report is attached.'
-            
-            # The HTML body of the email
-            body_html = """\
-            <html>
-            <head></head>
-            <body>
-            <h2>Notice:</h2>
-            <p>Your scheduled report is attached.</p>
-            </body>
-            </html>
-            """
-            
-            # Create a multipart/alternative child container
-            msg_body = MIMEMultipart('alternative')
-            
-            # Encode the text and HTML content and set the character encoding
-            textpart = MIMEText(body_text.encode(charset), 'plain', charset)
-            htmlpart = MIMEText(body_html.encode(charset), 'html', charset)
-            
-            # Add the text and HTML parts to the child container
-            msg_body.attach(textpart)
-            msg_body.attach(htmlpart)
-
-            # Mod the filename so that we can attach it
-            clean_filename = subject + " " + formatted_date + ".csv"
-            clean_filename = clean_filename.replace(" ", "_")
-
-            # Add the file, the header, and attach it to the email
-            attachment_part = MIMEApplication(attachment_body, clean_filename)
-            attachment_part.add_header('Content-Disposition', 'attachment', filename=clean_filename)
-            msg.attach(attachment_part)
-            
-            # Attach the multipart/alternative child container to the parent
-            msg.attach(msg_body)
-            msg.add_header('Return-Path', return_path)
-            msg.add_header('Reply-To', reply_to)
-            
-            # Send the email
-            try:
-                # Provide the contents of the email.
-                response = ses.send_raw_email(
-                    Source=sender,
-                    Destinations=recipient + cc,
-                    RawMessage={
-                        'Data':msg.as_string()
-                    }
-                )
-
-            # Display an error if something goes wrong
-            except ClientError as e:
-                print(e.response['Error']['Message'])
-
-            # Otherwise log the success for this file
-            else:
-                print('Email sent! Message ID:'),
-                print(response['MessageId'])
+    elif max_workers > 1 and len(records) > 1:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(records))) as executor:
+            results = list(executor.map(safe_process_record, records))
+
+    else:
+        results = [safe_process_record(i) for i in records]
+
+    # Summarise the batch, the per record results keep the event order
+    summary = {
+        'status': 'Complete',
+        'sent': sum(1 for result in results if result['status'] == 'sent'),
+        'skipped': sum(1 for result in results if result['status'] == 'skipped'),
+        'failed': sum(1 for result in results if result['status'] == 'failed'),
+        'duplicate': sum(1 for result in results if result['status'] == 'duplicate'),
+        'buffered': sum(1 for result in results if result['status'] == 'buffered'),
+        'results': results
+    }
 
     # Log a success for the entire process
     print('Successfully processed reports')
+    print(f"sent: {summary['sent']}, skipped: {summary['skipped']}, failed: {summary['failed']}, duplicate: {summary['duplicate']}, buffered: {summary['buffered']}")
+    print(f'client cache: {clients.stats()}')
+    print(f'idempotency: {idempotency.stats()}')
 
     # Return the response
-    return 'Complete'
\ No newline at end of file
+    return summary
\ No newline at end of file
@@ -0,0 +1,102 @@
+# Description: Change detection in front of a metric emitter. The last value
+# published for every metric and dimension set is remembered across warm
+# invocations and in /tmp; an entry whose value has not changed since is
+# dropped instead of being published again, except that every
+# delta_heartbeat-th unchanged entry is published anyway so that alarms and
+# dashboards keep receiving data. Enabled with delta_filter=on, see
+# create_emitter in metric_emitter.py.
+# Optional environment variables are listed in sample_readme/delta_filter.txt
+
+# Import relevant modules
+import json
+import threading
+from state_store import JsonFileStore
+
+# Last published values per state file, kept for the life of the container
+_memory = {}
+_memory_lock = threading.Lock()
+
+
+def datum_key(datum):
+    dimensions = [[dimension['Name'], dimension['Value']] for dimension in datum.get('Dimensions', [])]
+    return json.dumps([datum['MetricName'], dimensions], separators=(',', ':'))
+
+
+class DeltaFilter:
+
+    def __init__(self, emitter, store=None, heartbeat=12, last_values=None):
+        self.emitter = emitter
+        self.store = store
+        self.heartbeat = heartbeat
+
+        self._lock = threading.Lock()
+
+        # key -> [last published value, unchanged entries dropped since]
+        if last_values is None:
+            last_values = (store.load() if store else None) or {}
+
+        self._last_values = last_values
+
+        self.suppressed_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    @property
+    def failures(self):
+        return self.emitter.failures
+
+    def add(self, datum):
+        key = datum_key(datum)
+        value = datum['Value']
+
+        with self._lock:
+            last = self._last_values.get(key)
+
+            if last is not None and last[0] == value and last[1] + 1 < self.heartbeat:
+                last[1] += 1
+                self.suppressed_count += 1
+                return
+
+            self._last_values[key] = [value, 0]
+
+        self.emitter.add(datum)
+
+    def add_all(self, datums):
+        for datum in datums:
+            self.add(datum)
+
+    def flush(self):
+        failures = self.emitter.flush()
+
+        with self._lock:
+            # An entry CloudWatch rejected was never published, send it again
+            # next time even if the value stays the same
+            for datum, message in failures:
+                self._last_values.pop(datum_key(datum), None)
+
+            if self.store:
+                self.store.save(self._last_values)
+
+        return failures
+
+    def stats(self):
+        return dict(self.emitter.stats(), suppressed=self.suppressed_count)
+
+
+# Wrap an emitter, the remembered values of a state file are loaded from /tmp
+# once per container and shared by later invocations
+def delta_filter(emitter, config):
+    path = config.delta_state_path
+    store = JsonFileStore(path)
+
+    with _memory_lock:
+        if path not in _memory:
+            _memory[path] = store.load() or {}
+
+        last_values = _memory[path]
+
+    return DeltaFilter(emitter, store, heartbeat=config.delta_heartbeat, last_values=last_values)
@@ -0,0 +1,128 @@
+# Description: Rolling one hour window for the hourly Connect poller. In
+# rolling mode every queue keeps a ring buffer of twelve 5 minute buckets in
+# /tmp (or any other JSON file); each run only fetches the newest bucket, and
+# the trailing hour is summed from the buffer. After a cold start, or a gap of more than one bucket, the buffer
+# starts again from the newest bucket and fills up one run at a time; until it
+# holds the whole hour, the hour is published from one request of its own, as
+# in full mode. In full mode (the default) every run fetches the trailing hour
+# in one request, as before.
+# Optional environment variables are listed in sample_readme/hourly_window.txt
+
+# Import relevant modules
+from state_store import JsonFileStore
+
+BUCKET_SECONDS = 300
+WINDOW_SECONDS = 3600
+BUCKETS_PER_WINDOW = WINDOW_SECONDS // BUCKET_SECONDS
+
+
+class RollingWindow:
+
+    def __init__(self, store, instance_id, rolling=False):
+        self.store = store
+        self.instance_id = instance_id
+        self.rolling = rolling
+
+        self.end_timestamp = None
+        self._queues = {}
+
+        # End of the oldest bucket in the buffer, with no gaps since
+        self.start_timestamp = None
+
+        # Values of the trailing hour fetched in one request, by queue id;
+        # None when the hour is summed from the buffer
+        self._hour = None
+
+    # Returns the (StartTime, EndTime) windows this run has to fetch
+    def plan(self, end_timestamp):
+        self.end_timestamp = end_timestamp
+        hour = (end_timestamp - WINDOW_SECONDS, end_timestamp)
+
+        if not self.rolling:
+            self._hour = {}
+            return [hour]
+
+        state = self.store.load()
+        windows = [(end_timestamp - BUCKET_SECONDS, end_timestamp)]
+
+        # Carry on from the checkpoint when at most the newest bucket has
+        # closed since
+        if (state and state.get('instance_id') == self.instance_id and 'start' in state
+                and end_timestamp - BUCKET_SECONDS <= state['end'] <= end_timestamp):
+            self._queues = state['queues']
+            self.start_timestamp = state['start']
+            print(f"Resuming hourly window from checkpoint at {state['end']}")
+
+            if state['end'] == end_timestamp:
+                windows = []
+
+        # Cold start or a gap: the buffer starts again from the newest bucket
+        else:
+            self._queues = {}
+            self.start_timestamp = end_timestamp
+
+        # Until the buffer holds the whole hour, publish from one request for
+        # the hour instead of fetching every missing bucket on its own
+        self._hour = None
+
+        if self.start_timestamp > end_timestamp - WINDOW_SECONDS + BUCKET_SECONDS:
+            self._hour = {}
+            windows.append(hour)
+
+        return windows
+
+    # Store the values of one queue for a window that plan returned; only the
+    # metrics that were found are passed in
+    def add(self, window_start, window_end, queue_id, queue_arn, values):
+        if window_end - window_start == WINDOW_SECONDS:
+            self._hour[queue_id] = (queue_arn, values)
+            return
+
+        queue = self._queues.setdefault(queue_id, {'arn': queue_arn, 'slots': [None] * BUCKETS_PER_WINDOW})
+        queue['slots'][(window_end // BUCKET_SECONDS) % BUCKETS_PER_WINDOW] = [window_end, values]
+
+    # (queue id, queue arn, sums) for every queue with data in the trailing
+    # hour; a metric missing from every bucket is left out of the sums
+    def items(self):
+        if self._hour is not None:
+            for queue_id, (queue_arn, values) in self._hour.items():
+                yield queue_id, queue_arn, values
+
+            return
+
+        window_start = self.end_timestamp - WINDOW_SECONDS
+
+        for queue_id, queue in list(self._queues.items()):
+            slots = [slot for slot in queue['slots'] if slot and window_start < slot[0] <= self.end_timestamp]
+
+            # No data for the whole hour, the queue drops out of the buffer
+            if not slots:
+                del self._queues[queue_id]
+                continue
+
+            sums = {}
+
+            for bucket_end, values in slots:
+                for name, value in values.items():
+                    sums[name] = sums.get(name, 0) + value
+
+            yield queue_id, queue['arn'], sums
+
+    def save(self):
+        if self.rolling:
+            self.store.save({
+                'instance_id': self.instance_id,
+                'start': self.start_timestamp,
+                'end': self.end_timestamp,
+                'queues': self._queues
+            })
+
+
+# Built from the poller's config, where hourly_mode and hourly_state_path are
+# checked at cold start
+def rolling_window(config):
+    return RollingWindow(
+        JsonFileStore(config.hourly_state_path),
+        config.connect_instance_id,
+        rolling=config.hourly_mode == 'rolling'
+    )
@@ -0,0 +1,204 @@
+# Description: Idempotency store for S3 event records. S3 notifications are
+# delivered at least once, so a record is claimed before it is processed and
+# marked complete afterwards; a redelivered record (same bucket, key, eTag and
+# sequencer) is recognised and skipped before any S3, SES or CloudWatch call.
+# A small in-memory LRU answers repeats within a warm container, and an
+# optional persistent backend (DynamoDB, or SQLite as a local stand-in)
+# covers redeliveries that land on another container.
+# Optional environment variables are listed in sample_readme/idempotency.txt
+
+# Import relevant modules
+import threading
+import time
+from collections import OrderedDict
+
+IN_PROGRESS = 'IN_PROGRESS'
+COMPLETE = 'COMPLETE'
+
+
+def record_key(record):
+    s3_record = record['s3']
+
+    return '|'.join([
+        s3_record['bucket']['name'],
+        s3_record['object']['key'],
+        s3_record['object'].get('eTag', ''),
+        s3_record['object'].get('sequencer', '')
+    ])
+
+
+class LruCache:
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return True
+
+            return False
+
+    # Returns False when the key was already there
+    def add(self, key):
+        with self._lock:
+            added = key not in self._entries
+            self._entries[key] = True
+            self._entries.move_to_end(key)
+
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+            return added
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+# Local stand-in for the persistent backend, one row per claimed record
+class SqliteBackend:
+
+    def __init__(self, path):
+        # Only loaded when this backend is configured
+        import sqlite3
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS idempotency (key TEXT PRIMARY KEY, status TEXT NOT NULL, expires REAL NOT NULL)'
+        )
+
+    def claim(self, key, lease_seconds):
+        now = time.time()
+
+        with self._lock:
+            # Take the record when it is new, or when an earlier attempt died
+            # without finishing and its lease ran out
+            cursor = self._connection.execute(
+                'INSERT INTO idempotency (key, status, expires) VALUES (?, ?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET status = excluded.status, expires = excluded.expires '
+                'WHERE idempotency.expires < ?',
+                (key, IN_PROGRESS, now + lease_seconds, now)
+            )
+
+            return cursor.rowcount == 1
+
+    def complete(self, key, ttl_seconds):
+        with self._lock:
+            self._connection.execute(
+                'UPDATE idempotency SET status = ?, expires = ? WHERE key = ?',
+                (COMPLETE, time.time() + ttl_seconds, key)
+            )
+
+    def release(self, key):
+        with self._lock:
+            self._connection.execute('DELETE FROM idempotency WHERE key = ?', (key,))
+
+
+# Persistent backend shared by every container; the table needs a string
+# partition key named pk, and expires can be used as its TTL attribute
+class DynamoDBBackend:
+
+    def __init__(self, dynamodb, table_name):
+        self.dynamodb = dynamodb
+        self.table_name = table_name
+
+    def claim(self, key, lease_seconds):
+        now = int(time.time())
+
+        try:
+            self.dynamodb.put_item(
+                TableName=self.table_name,
+                Item={
+                    'pk': {'S': key},
+                    'status': {'S': IN_PROGRESS},
+                    'expires': {'N': str(now + lease_seconds)}
+                },
+                ConditionExpression='attribute_not_exists(pk) OR expires < :now',
+                ExpressionAttributeValues={':now': {'N': str(now)}}
+            )
+
+        except self.dynamodb.exceptions.ConditionalCheckFailedException:
+            return False
+
+        return True
+
+    def complete(self, key, ttl_seconds):
+        self.dynamodb.update_item(
+            TableName=self.table_name,
+            Key={'pk': {'S': key}},
+            UpdateExpression='SET #status = :status, expires = :expires',
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={
+                ':status': {'S': COMPLETE},
+                ':expires': {'N': str(int(time.time()) + ttl_seconds)}
+            }
+        )
+
+    def release(self, key):
+        self.dynamodb.delete_item(TableName=self.table_name, Key={'pk': {'S': key}})
+
+
+class IdempotencyStore:
+
+    def __init__(self, backend=None, lru_size=1024, lease_seconds=900, ttl_seconds=86400):
+        self.backend = backend
+        self.lease_seconds = lease_seconds
+        self.ttl_seconds = ttl_seconds
+
+        # Keys claimed in this container, completed or still in progress
+        self._seen = LruCache(lru_size)
+
+        self.duplicate_count = 0
+
+    # True when the caller should process the record, False for a duplicate
+    def claim(self, key):
+        if not self._seen.add(key):
+            self.duplicate_count += 1
+            return False
+
+        # Claimed by another container; forget it here so that a redelivery
+        # after that container released it is processed
+        if self.backend and not self.backend.claim(key, self.lease_seconds):
+            self._seen.discard(key)
+            self.duplicate_count += 1
+            return False
+
+        return True
+
+    def complete(self, key):
+        if self.backend:
+            self.backend.complete(key, self.ttl_seconds)
+
+    # Processing failed, let a later delivery of the record try again
+    def release(self, key):
+        self._seen.discard(key)
+
+        if self.backend:
+            self.backend.release(key)
+
+    def stats(self):
+        return {'duplicates': self.duplicate_count}
+
+
+# Built from the handler's config, where the idempotency_* options are
+# checked at cold start
+def idempotency_store(config):
+    backend = None
+
+    if config.idempotency_backend == 'sqlite':
+        backend = SqliteBackend(config.idempotency_path)
+
+    elif config.idempotency_backend == 'dynamodb':
+        from client_cache import clients
+        backend = DynamoDBBackend(clients.get('dynamodb'), config.idempotency_table)
+
+    return IdempotencyStore(
+        backend,
+        lru_size=config.idempotency_cache_size,
+        ttl_seconds=config.idempotency_ttl
+    )
@@ -0,0 +1,73 @@
+# Description: Small levelled logger for the sample handlers. Payloads such as
+# events and API responses are only serialized when their level is enabled and
+# are cut to log_max_chars characters, so a large response does not end up in
+# CloudWatch Logs in full. Debug output can be turned on for a fraction of the
+# invocations with log_debug_sample_rate, to get full detail from some runs
+# without paying for it on every run.
+# Optional environment variables are listed in sample_readme/logger.txt
+
+# Import relevant modules
+import json
+import os
+import random
+
+LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+
+
+def truncate(text, max_chars):
+    if max_chars and len(text) > max_chars:
+        return f'{text[:max_chars]}... [{len(text) - max_chars} more characters]'
+
+    return text
+
+
+class Logger:
+
+    def __init__(self, level='INFO', max_chars=2000, debug_sample_rate=0.0):
+        # An unknown level falls back to INFO instead of failing the cold start
+        self.level = LEVELS.get(level.upper(), LEVELS['INFO'])
+        self.max_chars = max_chars
+        self.debug_sample_rate = debug_sample_rate
+
+        # Level for the current invocation, lowered to DEBUG when sampled
+        self._invocation_level = self.level
+
+    # Call at the start of every invocation to roll the debug sample
+    def start_invocation(self):
+        self._invocation_level = self.level
+
+        if self.debug_sample_rate and random.random() < self.debug_sample_rate:
+            self._invocation_level = LEVELS['DEBUG']
+
+    def enabled(self, level):
+        return LEVELS[level] >= self._invocation_level
+
+    def log(self, level, message, payload=None):
+        if not self.enabled(level):
+            return
+
+        if payload is not None:
+            text = payload if isinstance(payload, str) else json.dumps(payload, default=str)
+            message = f'{message}: {truncate(text, self.max_chars)}'
+
+        print(f'{level} {message}')
+
+    def debug(self, message, payload=None):
+        self.log('DEBUG', message, payload)
+
+    def info(self, message, payload=None):
+        self.log('INFO', message, payload)
+
+    def warning(self, message, payload=None):
+        self.log('WARNING', message, payload)
+
+    def error(self, message, payload=None):
+        self.log('ERROR', message, payload)
+
+
+# Created at import so that every module of a handler shares the settings
+logger = Logger(
+    level=os.environ.get('log_level', 'INFO'),
+    max_chars=int(os.environ.get('log_max_chars', '2000')),
+    debug_sample_rate=float(os.environ.get('log_debug_sample_rate', '0'))
+)
@@ -0,0 +1,335 @@
+# Description: Buffered CloudWatch metric emitter shared by the metric
+# handlers. MetricData entries from every queue (or report row) are collected
+# and sent in as few PutMetricData calls as the API allows, instead of one call
+# per queue. The buffer is flushed when the next entry would not fit in the
+# current request and once more when the handler finishes. With
+# metric_publish_workers above 0 full batches are sent by background workers,
+# so that the handler keeps fetching while earlier batches are published.
+# With metric_output set to emf the same entries are written to stdout in
+# CloudWatch Embedded Metric Format instead, and no API calls are made.
+# Optional environment variables are listed in sample_readme/metric_emitter.txt
+
+# Import relevant modules
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+from botocore.exceptions import ClientError
+from logger import logger
+
+# PutMetricData accepts up to 1000 MetricDatum entries and a 1 MB request body
+MAX_DATUMS_PER_REQUEST = 1000
+MAX_REQUEST_BYTES = 1000000
+
+# Room left for Action, Version and Namespace in the request body
+REQUEST_OVERHEAD_BYTES = 512
+
+# Errors caused by the content of an entry; the batch is split to find the
+# entries at fault instead of failing every entry in it
+VALIDATION_ERRORS = ('InvalidParameterValue', 'InvalidParameterCombination', 'MissingParameter')
+
+# An Embedded Metric Format document may hold at most 100 metrics
+MAX_METRICS_PER_DOCUMENT = 100
+
+# Publish worker pools by size, shared by every emitter of the container so
+# that the threads are started once
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def _publish_executor(workers):
+    with _executors_lock:
+        if workers not in _executors:
+            _executors[workers] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='metric-publish')
+
+        return _executors[workers]
+
+
+# Estimate the size of a datum once it is form encoded into the request, e.g.
+# MetricData.member.1000.Dimensions.member.1.Value=abc&
+def datum_size(datum, prefix='MetricData.member.1000'):
+    if isinstance(datum, dict):
+        return sum(datum_size(value, prefix + '.' + key) for key, value in datum.items())
+
+    if isinstance(datum, (list, tuple)):
+        return sum(datum_size(value, prefix + '.member.' + str(index + 1)) for index, value in enumerate(datum))
+
+    if hasattr(datum, 'isoformat'):
+        datum = datum.isoformat()
+
+    return len(prefix) + len(quote(str(datum), safe='')) + 2
+
+
+class MetricEmitter:
+
+    def __init__(self, cloudwatch, namespace, max_datums=MAX_DATUMS_PER_REQUEST, max_bytes=MAX_REQUEST_BYTES, publish_workers=0):
+        self.cloudwatch = cloudwatch
+        self.namespace = namespace
+        self.max_datums = max_datums
+        self.max_bytes = max_bytes - REQUEST_OVERHEAD_BYTES - len(namespace)
+
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._buffer_bytes = 0
+
+        # Counters and failures are updated by the publish workers
+        self._stats_lock = threading.Lock()
+
+        # Background publishing; at most two batches per worker wait to be
+        # sent, after that add() blocks until a worker is free
+        self._executor = None
+        self._pending = []
+
+        if publish_workers > 0:
+            self._executor = _publish_executor(publish_workers)
+            self._slots = threading.BoundedSemaphore(publish_workers * 2)
+
+        # Running totals for the log line at the end of the handler
+        self.sent_count = 0
+        self.request_count = 0
+
+        # One (datum, error message) pair per entry that CloudWatch rejected
+        self.failures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def add(self, datum):
+        size = datum_size(datum)
+        batch = None
+
+        with self._lock:
+            # Send what we have first if this entry would not fit in the request
+            if self._buffer and (len(self._buffer) >= self.max_datums or self._buffer_bytes + size > self.max_bytes):
+                batch = self._take_buffer()
+
+            self._buffer.append(datum)
+            self._buffer_bytes += size
+
+        # Sent outside the lock, so other threads can keep adding meanwhile
+        if batch:
+            self._dispatch(batch)
+
+    def add_all(self, datums):
+        for datum in datums:
+            self.add(datum)
+
+    def flush(self):
+        with self._lock:
+            batch = self._take_buffer()
+
+        if batch:
+            self._dispatch(batch)
+
+        # Wait for the batches that are still with the publish workers
+        with self._stats_lock:
+            pending, self._pending = self._pending, []
+
+        for future in pending:
+            future.result()
+
+        return self.failures
+
+    def stats(self):
+        return {
+            'sent': self.sent_count,
+            'failed': len(self.failures),
+            'requests': self.request_count
+        }
+
+    def _take_buffer(self):
+        batch = self._buffer
+        self._buffer = []
+        self._buffer_bytes = 0
+        return batch
+
+    def _dispatch(self, batch):
+        if self._executor is None:
+            self._send(batch)
+            return
+
+        # Backpressure: wait for a free slot before queueing another batch
+        self._slots.acquire()
+        future = self._executor.submit(self._send, batch)
+        future.add_done_callback(lambda future: self._slots.release())
+
+        with self._stats_lock:
+            self._pending = [pending for pending in self._pending if not pending.done()]
+            self._pending.append(future)
+
+    def _send(self, batch):
+        with self._stats_lock:
+            self.request_count += 1
+
+        try:
+            self.cloudwatch.put_metric_data(Namespace=self.namespace, MetricData=batch)
+
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            message = e.response['Error']['Message']
+
+            # Split the batch in two so that the valid entries still get sent
+            if code in VALIDATION_ERRORS and len(batch) > 1:
+                middle = len(batch) // 2
+                self._send(batch[:middle])
+                self._send(batch[middle:])
+
+            else:
+                self._fail(batch, message)
+
+        # Connection errors, timeouts or the rate limiter running out of time;
+        # with background workers nobody else would see them
+        except Exception as e:
+            self._fail(batch, str(e))
+
+        else:
+            with self._stats_lock:
+                self.sent_count += len(batch)
+
+    # One log line per failed batch, however many entries it held
+    def _fail(self, batch, message):
+        logger.error(f"Failed to put {len(batch)} metrics ({batch[0]['MetricName']}, ...): {message}")
+
+        with self._stats_lock:
+            self.failures.extend((datum, message) for datum in batch)
+
+
+class EmbeddedMetricEmitter:
+
+    def __init__(self, namespace, max_datums=MAX_DATUMS_PER_REQUEST, stream=None):
+        self.namespace = namespace
+        self.max_datums = max_datums
+        self.stream = stream
+
+        self._lock = threading.Lock()
+
+        # Entries that share a timestamp and dimensions go into one document,
+        # for the Connect pollers that is one log line per queue
+        self._documents = {}
+        self._buffer_count = 0
+
+        self.sent_count = 0
+        self.line_count = 0
+        self.failures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def add(self, datum):
+        dimensions = tuple((dimension['Name'], dimension['Value']) for dimension in datum.get('Dimensions', []))
+        timestamp = datum.get('Timestamp')
+
+        if timestamp is None:
+            timestamp_ms = int(time.time() * 1000)
+
+        elif hasattr(timestamp, 'timestamp'):
+            timestamp_ms = int(timestamp.timestamp() * 1000)
+
+        else:
+            timestamp_ms = int(timestamp * 1000)
+
+        with self._lock:
+            if self._buffer_count >= self.max_datums:
+                self._write(self._take_documents())
+
+            key = (timestamp_ms, dimensions)
+            documents = self._documents.setdefault(key, [])
+
+            # Start a new document when the current one is full
+            if not documents or len(documents[-1]['metrics']) >= MAX_METRICS_PER_DOCUMENT:
+                documents.append({'metrics': {}, 'values': {}, 'count': 0})
+
+            document = documents[-1]
+            name = datum['MetricName']
+
+            definition = {'Name': name, 'Unit': datum.get('Unit', 'None')}
+
+            if datum.get('StorageResolution') == 1:
+                definition['StorageResolution'] = 1
+
+            document['metrics'][name] = definition
+
+            # A second value for the same metric turns it into a value array
+            if name in document['values']:
+                values = document['values'][name]
+                document['values'][name] = (values if isinstance(values, list) else [values]) + [datum['Value']]
+
+            else:
+                document['values'][name] = datum['Value']
+
+            document['count'] += 1
+            self._buffer_count += 1
+
+    def add_all(self, datums):
+        for datum in datums:
+            self.add(datum)
+
+    def flush(self):
+        with self._lock:
+            if self._documents:
+                self._write(self._take_documents())
+
+        return self.failures
+
+    def stats(self):
+        return {
+            'sent': self.sent_count,
+            'failed': 0,
+            'lines': self.line_count
+        }
+
+    def _take_documents(self):
+        documents = self._documents
+        self._documents = {}
+        self._buffer_count = 0
+        return documents
+
+    def _write(self, documents):
+        for (timestamp_ms, dimensions), parts in documents.items():
+            for part in parts:
+                record = {
+                    '_aws': {
+                        'Timestamp': timestamp_ms,
+                        'CloudWatchMetrics': [
+                            {
+                                'Namespace': self.namespace,
+                                'Dimensions': [[name for name, value in dimensions]],
+                                'Metrics': list(part['metrics'].values())
+                            }
+                        ]
+                    }
+                }
+                record.update(dimensions)
+                record.update(part['values'])
+
+                # Each document has to be a single line in the log
+                print(json.dumps(record, default=str), file=self.stream, flush=True)
+
+                self.sent_count += part['count']
+                self.line_count += 1
+
+
+# Pick the output for this deployment from its config: api (PutMetricData)
+# or emf (stdout), behind the change detection of delta_filter.py when
+# delta_filter is on
+def create_emitter(config):
+    if config.metric_output == 'emf':
+        emitter = EmbeddedMetricEmitter(config.namespace)
+
+    else:
+        # Only build the CloudWatch client when the API is actually used
+        from client_cache import clients
+        emitter = MetricEmitter(clients.get('cloudwatch'), config.namespace, publish_workers=config.metric_publish_workers)
+
+    if config.delta_filter == 'on':
+        from delta_filter import delta_filter
+        return delta_filter(emitter, config)
+
+    return emitter
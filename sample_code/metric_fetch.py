@@ -0,0 +1,130 @@
+# Description: Chunked, parallel fetch layer for get_metric_data and
+# get_current_metric_data. The queue list is split into chunks that fit the
+# API's Filters limit, the chunks are fetched concurrently on a bounded thread
+# pool, every NextToken page is read, and the MetricResults of all chunks are
+# returned as one stream of per-queue records. Pages are handed over through a
+# bounded queue as they arrive, so the caller works on one page while the next
+# ones are fetched, and memory stays bounded however many queues there are.
+# Optional environment variables are listed in sample_readme/metric_fetch.txt
+# and checked by PollerConfig in config.py
+
+# Import relevant modules
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logger import logger
+
+# Both APIs accept at most 100 queues in Filters and return 100 results a page
+MAX_QUEUES_PER_REQUEST = 100
+MAX_RESULTS_PER_PAGE = 100
+
+# Defaults of the fetch_* options of PollerConfig
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_CHUNK_SIZE = MAX_QUEUES_PER_REQUEST
+
+# Pages fetched ahead of the caller, at most 100 results each
+DEFAULT_QUEUE_SIZE = 8
+
+
+def chunk_queue_ids(queue_ids, chunk_size=DEFAULT_CHUNK_SIZE):
+    return [queue_ids[i:i + chunk_size] for i in range(0, len(queue_ids), chunk_size)]
+
+
+# Yield every page of MetricResults for one chunk of queues
+def iter_chunk_pages(operation, queue_ids, request):
+    kwargs = dict(request)
+    kwargs['Filters'] = dict(request['Filters'], Queues=queue_ids)
+    kwargs['MaxResults'] = MAX_RESULTS_PER_PAGE
+
+    while True:
+        response = operation(**kwargs)
+
+        # Whole pages are only written at debug level, and cut short
+        logger.debug(f"{getattr(operation, '__name__', 'metric')} page with {len(response['MetricResults'])} results", response)
+
+        yield response['MetricResults']
+
+        if not response.get('NextToken'):
+            break
+
+        kwargs['NextToken'] = response['NextToken']
+
+
+# Put on the page queue by a fetch worker once its chunk is done, with the
+# error that stopped it if there was one
+class _ChunkDone:
+
+    def __init__(self, error=None):
+        self.error = error
+
+
+# operation is the client method, e.g. connect.get_metric_data, and request
+# holds the rest of its parameters except for Filters['Queues']. The chunks are
+# fetched by up to max_workers threads that put each page on a queue of at most
+# queue_size pages, and the caller gets the results of every page as soon as
+# it arrives; a full queue holds the workers back until the caller catches up
+def fetch_metric_results(operation, queue_ids, max_workers=DEFAULT_MAX_WORKERS, chunk_size=DEFAULT_CHUNK_SIZE, queue_size=DEFAULT_QUEUE_SIZE, **request):
+    chunks = chunk_queue_ids(queue_ids, chunk_size)
+
+    if not chunks:
+        return
+
+    # Skip the thread pool when one request covers every queue
+    if len(chunks) == 1:
+        for page in iter_chunk_pages(operation, chunks[0], request):
+            yield from page
+
+        return
+
+    pages = queue.Queue(maxsize=queue_size)
+    stopped = threading.Event()
+
+    # Wait for room on the queue, unless the caller has gone away
+    def put(item):
+        while not stopped.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return
+
+            except queue.Full:
+                continue
+
+    def fetch(chunk):
+        try:
+            for page in iter_chunk_pages(operation, chunk, request):
+                if stopped.is_set():
+                    break
+
+                put(page)
+
+        except Exception as e:
+            put(_ChunkDone(e))
+
+        else:
+            put(_ChunkDone())
+
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(chunks)))
+
+    try:
+        for chunk in chunks:
+            executor.submit(fetch, chunk)
+
+        remaining = len(chunks)
+
+        while remaining:
+            item = pages.get()
+
+            if isinstance(item, _ChunkDone):
+                remaining -= 1
+
+                if item.error:
+                    raise item.error
+
+                continue
+
+            yield from item
+
+    finally:
+        # Let the workers finish when the caller stops early or a chunk failed
+        stopped.set()
+        executor.shutdown(wait=True)
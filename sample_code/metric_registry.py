@@ -0,0 +1,116 @@
+# Description: Declarative metric tables for the Connect pollers. One row per
+# metric drives the get_metric_data / get_current_metric_data request, the
+# decoding of the Collections in MetricResults (a dict lookup instead of an
+# if/elif chain) and the MetricData entries that are published. Adding a metric
+# is one new row. The request payloads are built once at import, and the
+# Dimensions block is built once per queue and shared by all of its metrics.
+
+# Import relevant modules
+from collections import namedtuple
+
+# api_name: name in the Connect API, metric_name: name in CloudWatch
+MetricDefinition = namedtuple('MetricDefinition', ['api_name', 'metric_name', 'unit', 'api_unit', 'statistic'])
+
+
+def metric(api_name, metric_name, unit='Count', api_unit='COUNT', statistic='SUM'):
+    return MetricDefinition(api_name, metric_name, unit, api_unit, statistic)
+
+
+class MetricTable:
+
+    def __init__(self, definitions, default):
+        self.definitions = tuple(definitions)
+
+        # Published when a metric is missing from the API response
+        self.default = default
+
+        self._by_api_name = {definition.api_name: definition for definition in self.definitions}
+
+        # Request payloads, built once and reused by every invocation
+        self.historical_metrics = [
+            {'Name': definition.api_name, 'Unit': definition.api_unit, 'Statistic': definition.statistic}
+            for definition in self.definitions
+        ]
+        self.current_metrics = [
+            {'Name': definition.api_name, 'Unit': definition.api_unit}
+            for definition in self.definitions
+        ]
+
+    # api_name -> value for the metrics of this table found in one result
+    def decode(self, item):
+        values = {}
+
+        for collection in item['Collections']:
+            name = collection['Metric']['Name']
+
+            if name in self._by_api_name:
+                values[name] = collection['Value']
+
+        return values
+
+    # MetricData entries for one queue, in table order; storage_resolution=1
+    # publishes them as high resolution metrics
+    def datums(self, dimensions, values, timestamp, storage_resolution=None):
+        datums = [
+            {
+                'MetricName': definition.metric_name,
+                'Dimensions': dimensions,
+                'Timestamp': timestamp,
+                'Value': values.get(definition.api_name, self.default),
+                'Unit': definition.unit
+            }
+            for definition in self.definitions
+        ]
+
+        if storage_resolution:
+            for datum in datums:
+                datum['StorageResolution'] = storage_resolution
+
+        return datums
+
+
+# Built once per queue and shared by every MetricData entry of that queue
+def queue_dimensions(queue_id, queue_arn, queue_name):
+    return [
+        {
+            'Name': 'Id',
+            'Value': queue_id
+        },
+        {
+            'Name': 'Arn',
+            'Value': queue_arn
+        },
+        {
+            'Name': 'Queue Name',
+            'Value': queue_name
+        }
+    ]
+
+
+# connect-get-realtime-data.py, if -1 shows up there was an error in retrieval
+REALTIME_METRICS = MetricTable([
+    metric('AGENTS_ONLINE', 'Agents Online'),
+    metric('AGENTS_ON_CALL', 'Agents On Call')
+], default=-1)
+
+# connect-get-historical-data.py, totals since midnight, 0 when not found
+DAILY_METRICS = MetricTable([
+    metric('CONTACTS_QUEUED', 'Contacts Queued Daily'),
+    metric('CONTACTS_HANDLED', 'Contacts Handled'),
+    metric('CONTACTS_HANDLED_OUTBOUND', 'Contacts Handled Outbound'),
+    metric('CONTACTS_HANDLED_INCOMING', 'Contacts Handled Incoming')
+], default=0)
+
+# connect-get-historical-data-hourly.py, trailing hour, if -1 shows up there
+# was either an error in retrieval or no data found
+HOURLY_METRICS = MetricTable([
+    metric('CONTACTS_TRANSFERRED_IN', 'Contacts Transferred In'),
+    metric('CONTACTS_TRANSFERRED_IN_FROM_QUEUE', 'Contacts Transferred In From Queue'),
+    metric('CONTACTS_TRANSFERRED_OUT', 'Contacts Transferred Out'),
+    metric('CONTACTS_TRANSFERRED_OUT_FROM_QUEUE', 'Contacts Transferred Out From Queue'),
+    metric('CONTACTS_QUEUED', 'Contacts Queued Hourly'),
+    metric('CONTACTS_ABANDONED', 'Contacts Abandoned'),
+    metric('CONTACTS_AGENT_HUNG_UP_FIRST', 'Contacts Agent Hung Up'),
+    metric('CONTACTS_HOLD_ABANDONS', 'Contacts Hold Abandons'),
+    metric('CONTACTS_MISSED', 'Contacts Missed')
+], default=-1)
@@ -0,0 +1,158 @@
+# Description: Cached queue id -> name directory for the Connect pollers.
+# list_queues is followed through every NextToken page, and the result is kept
+# in memory and in /tmp for queue_cache_ttl seconds. When the cache has expired
+# the stale copy is served while a background thread refreshes it, and an
+# unknown queue id in the metric results forces an immediate refresh.
+# Optional environment variables are listed in sample_readme/queue_directory.txt
+
+# Import relevant modules
+import threading
+import time
+from state_store import JsonFileStore
+
+# list_queues returns at most 1000 queues per page
+LIST_QUEUES_PAGE_SIZE = 1000
+
+# Do not refresh more than once in this many seconds because of unknown ids
+MISS_REFRESH_INTERVAL = 30
+
+
+class QueueDirectory:
+
+    def __init__(self, connect, instance_id, ttl_seconds=300, cache_path=None, queue_types=('STANDARD',)):
+        self.connect = connect
+        self.instance_id = instance_id
+        self.ttl_seconds = ttl_seconds
+        self.queue_types = list(queue_types)
+        self.store = JsonFileStore(cache_path) if cache_path else None
+
+        self._lock = threading.Lock()
+        self._refresh_thread = None
+        self._names = None
+        self._loaded_at = 0
+        self._last_miss_refresh = 0
+
+        self.refresh_count = 0
+
+        # Start from the /tmp copy if an earlier container left one behind
+        if self.store:
+            cached = self.store.load()
+
+            if cached and cached.get('instance_id') == instance_id:
+                self._names = cached['queues']
+                self._loaded_at = cached['loaded_at']
+
+    def queues(self):
+        # Nothing cached at all, so we have to wait for the API
+        if self._names is None:
+            self.refresh()
+
+        # Expired, serve the stale copy and refresh it in the background
+        elif time.time() - self._loaded_at >= self.ttl_seconds:
+            self._refresh_in_background()
+
+        return self._names
+
+    def queue_ids(self):
+        return list(self.queues())
+
+    def name(self, queue_id):
+        queue_name = self.queues().get(queue_id)
+
+        # A queue we have not seen yet, most likely created since the last refresh
+        if queue_name is None and time.time() - self._last_miss_refresh >= MISS_REFRESH_INTERVAL:
+            self._last_miss_refresh = time.time()
+            self.refresh()
+            queue_name = self._names.get(queue_id)
+
+        # Fall back to the id so that the metrics still get published
+        if queue_name is None:
+            print(f'Queue {queue_id} not found in list_queues')
+            return queue_id
+
+        return queue_name
+
+    def refresh(self):
+        names = {}
+        kwargs = {
+            'InstanceId': self.instance_id,
+            'QueueTypes': self.queue_types,
+            'MaxResults': LIST_QUEUES_PAGE_SIZE
+        }
+
+        # Follow NextToken until every page has been read
+        while True:
+            response = self.connect.list_queues(**kwargs)
+
+            for queue in response['QueueSummaryList']:
+                names[queue['Id']] = queue['Name']
+
+            if not response.get('NextToken'):
+                break
+
+            kwargs['NextToken'] = response['NextToken']
+
+        with self._lock:
+            self._names = names
+            self._loaded_at = time.time()
+            self.refresh_count += 1
+
+        if self.store:
+            self.store.save({
+                'instance_id': self.instance_id,
+                'loaded_at': self._loaded_at,
+                'queues': names
+            })
+
+        return names
+
+    def wait(self):
+        # Let a background refresh finish, e.g. before the handler returns
+        thread = self._refresh_thread
+
+        if thread:
+            thread.join()
+
+    def stats(self):
+        return {
+            'queues': len(self._names or {}),
+            'refreshes': self.refresh_count
+        }
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refresh_thread and self._refresh_thread.is_alive():
+                return
+
+            self._refresh_thread = threading.Thread(target=self._background_refresh, daemon=True)
+            self._refresh_thread.start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+
+        # Keep serving the stale copy, the next expired lookup tries again
+        except Exception as e:
+            print(f'Background queue refresh failed: {e}')
+
+
+# One directory per Connect instance, kept for the life of the container
+_directories = {}
+
+
+# Built from the poller's config, where queue_cache_ttl and queue_cache_path
+# are checked at cold start
+def queue_directory(connect, config):
+    instance_id = config.connect_instance_id
+    directory = _directories.get(instance_id)
+
+    if directory is None:
+        directory = QueueDirectory(
+            connect,
+            instance_id,
+            ttl_seconds=config.queue_cache_ttl,
+            cache_path=config.queue_cache_path
+        )
+        _directories[instance_id] = directory
+
+    return directory
@@ -0,0 +1,223 @@
+# Description: Client side rate limiting and retries for the AWS calls of the
+# sample handlers. Every API has a token bucket (Connect's get_metric_data,
+# get_current_metric_data and list_queues have low per second quotas), so that
+# concurrent chunks queue up on the client instead of being throttled. The
+# bucket's rate is halved when the service throttles anyway and grows back on
+# success. Throttled and transient errors, 5xx responses and requests that got
+# no response at all (botocore's own retries are off) are retried with jittered
+# exponential backoff until the attempts run out or the invocation's deadline,
+# taken from context.get_remaining_time_in_millis(), would be passed.
+# Optional environment variables are listed in sample_readme/rate_limiter.txt
+
+# Import relevant modules
+import random
+import threading
+import time
+from botocore.exceptions import ClientError, ConnectionError as BotocoreConnectionError, HTTPClientError
+
+# Per second rate and burst per service.method; unlisted APIs are not limited
+# but still retried
+DEFAULT_LIMITS = {
+    'connect.get_metric_data': (5, 8),
+    'connect.get_current_metric_data': (5, 8),
+    'connect.list_queues': (2, 5),
+    'cloudwatch.put_metric_data': (150, 150)
+}
+
+THROTTLE_ERRORS = (
+    'TooManyRequestsException', 'ThrottlingException', 'Throttling', 'ThrottledException',
+    'RequestLimitExceeded', 'SlowDown', 'ProvisionedThroughputExceededException'
+)
+
+TRANSIENT_ERRORS = ('InternalServiceException', 'InternalFailure', 'InternalError', 'ServiceUnavailable', 'ServiceUnavailableException')
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = float(burst)
+
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+
+    # Take a token, waiting for it if needed; returns the seconds waited
+    def acquire(self, deadline=None):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+            wait = 0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+            if deadline is not None and now + wait > deadline:
+                raise DeadlineExceeded('No time left to wait for the rate limit')
+
+            # Taken now, so callers that arrive later wait behind this one
+            self._tokens -= 1
+
+        if wait:
+            time.sleep(wait)
+
+        return wait
+
+    # Slow down after the service throttled us, speed up again on success
+    def throttled(self):
+        with self._lock:
+            self.rate = max(self.rate / 2, self.max_rate / 16)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class RateLimiter:
+
+    def __init__(self, limits=None, max_attempts=5, base_delay=0.1, max_delay=5.0, deadline_reserve_ms=1000):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline_reserve_ms = deadline_reserve_ms
+
+        self._buckets = {name: TokenBucket(rate, burst) for name, (rate, burst) in (limits or {}).items()}
+        self._lock = threading.Lock()
+        self._deadline = None
+
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.counters = {'calls': 0, 'throttled': 0, 'retries': 0, 'gave_up': 0, 'wait_ms': 0}
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    # Call at the start of every invocation with the Lambda context, the
+    # retries then stop in time for the handler to finish
+    def start_invocation(self, context=None):
+        self.reset_counters()
+        self._deadline = None
+
+        if context is not None:
+            remaining_ms = context.get_remaining_time_in_millis() - self.deadline_reserve_ms
+            self._deadline = time.monotonic() + remaining_ms / 1000
+
+    def call(self, api_name, function, *args, **kwargs):
+        bucket = self._buckets.get(api_name)
+        attempt = 0
+
+        while True:
+            attempt += 1
+
+            if bucket:
+                self._count('wait_ms', int(bucket.acquire(self._deadline) * 1000))
+
+            self._count('calls')
+
+            try:
+                result = function(*args, **kwargs)
+
+            # No response: the connection could not be made, was closed or
+            # timed out (EndpointConnectionError, ReadTimeoutError, ...)
+            except (BotocoreConnectionError, HTTPClientError):
+                if not self._backoff(attempt):
+                    raise
+
+                continue
+
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code')
+                status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+
+                if code not in THROTTLE_ERRORS and code not in TRANSIENT_ERRORS and status < 500:
+                    raise
+
+                if code in THROTTLE_ERRORS:
+                    self._count('throttled')
+
+                    if bucket:
+                        bucket.throttled()
+
+                if not self._backoff(attempt):
+                    raise
+
+                continue
+
+            if bucket:
+                bucket.succeeded()
+
+            return result
+
+    # Waits before the next attempt; returns False when there is none left
+    def _backoff(self, attempt):
+
+        # Full jitter: anywhere between no wait and the exponential cap
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+        if attempt >= self.max_attempts or (self._deadline is not None and time.monotonic() + delay > self._deadline):
+            self._count('gave_up')
+            return False
+
+        self._count('retries')
+        time.sleep(delay)
+
+        return True
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+# Stands in for a client; its API methods go through the limiter and every
+# other attribute (exceptions, meta, get_paginator, ...) is the client's own
+class LimitedClient:
+
+    def __init__(self, client, service, limiter):
+        self._client = client
+        self._service = service
+        self._limiter = limiter
+        self._methods = {}
+
+        # boto3 clients list their API methods, for other clients (e.g. local
+        # stand-ins) every public method is treated as one
+        meta = getattr(client, 'meta', None)
+        self._api_methods = set(meta.method_to_api_mapping) if hasattr(meta, 'method_to_api_mapping') else None
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+
+        if name.startswith('_') or not callable(attribute) or (self._api_methods is not None and name not in self._api_methods):
+            return attribute
+
+        method = self._methods.get(name)
+
+        if method is None:
+            api_name = f'{self._service}.{name}'
+
+            def method(*args, **kwargs):
+                return self._limiter.call(api_name, attribute, *args, **kwargs)
+
+            method.__name__ = name
+            self._methods[name] = method
+
+        return method
+
+
+# Built from the ClientConfig of client_cache.py, where rate_limits and the
+# retry_* options are checked at cold start
+def limiter_from_config(config):
+    limits = dict(DEFAULT_LIMITS)
+    limits.update(config.rate_limits)
+
+    return RateLimiter(
+        limits,
+        max_attempts=config.retry_max_attempts,
+        base_delay=config.retry_base_delay,
+        max_delay=config.retry_max_delay
+    )
@@ -0,0 +1,210 @@
+# Description: Digest mode for the report distributor. Reports that go to the
+# same To and Cc addresses are sent together, as attachments of one email,
+# instead of one email each. The reports are packed into as few messages as
+# fit under the SES raw message size, using the object sizes from the S3
+# notifications so that nothing is read before the plan is made. In window
+# mode the reports are also held for a few seconds, so that reports landing in
+# separate invocations share an email too; they wait in a DynamoDB table
+# shared by every container, or in a JSON file in /tmp as a local stand-in.
+# Environment variables are listed in sample_readme/daily_reports_distributor.txt
+
+# Import relevant modules
+import json
+import time
+from state_store import JsonFileStore
+
+# SES rejects raw messages above 10 MB, counted after base64 encoding
+SES_MAX_MESSAGE_BYTES = 10 * 1024 * 1024
+
+# Headers and the text and HTML bodies of a message, and the MIME headers of
+# each attachment
+MESSAGE_OVERHEAD_BYTES = 16 * 1024
+ATTACHMENT_OVERHEAD_BYTES = 1024
+
+# Sending attempts for a buffered report before it is dropped
+MAX_ATTEMPTS = 3
+
+
+# Size of an attachment in the raw message, base64 encoded in lines of 76
+# characters
+def encoded_size(size):
+    base64_size = (size + 2) // 3 * 4
+
+    return base64_size + base64_size // 76 * 2 + ATTACHMENT_OVERHEAD_BYTES
+
+
+# Groups the reports by recipients and splits every group into messages that
+# stay under max_bytes, largest report first (first fit decreasing); returns
+# (recipient, cc, reports) per message. A report too large to share a message
+# is sent on its own.
+def plan_digests(reports, max_bytes=SES_MAX_MESSAGE_BYTES):
+    max_bytes = min(max_bytes, SES_MAX_MESSAGE_BYTES)
+    groups = {}
+
+    for report in reports:
+        groups.setdefault((tuple(report['recipient']), tuple(report['cc'])), []).append(report)
+
+    digests = []
+
+    for (recipient, cc), group in groups.items():
+        messages = []
+
+        for report in sorted(group, key=lambda report: report['size'], reverse=True):
+            size = encoded_size(report['size'])
+
+            for message in messages:
+                if message['bytes'] + size <= max_bytes:
+                    message['bytes'] += size
+                    message['reports'].append(report)
+                    break
+
+            else:
+                messages.append({'bytes': MESSAGE_OVERHEAD_BYTES + size, 'reports': [report]})
+
+        # Attachments in the order of their keys
+        for message in messages:
+            digests.append((list(recipient), list(cc), sorted(message['reports'], key=lambda report: report['key'])))
+
+    return digests
+
+
+# Local stand-in for the shared backend: the reports waiting in one container,
+# in a JSON file (e.g. in /tmp). Reports still waiting when the container is
+# recycled are not sent.
+class JsonFileBackend:
+
+    def __init__(self, path):
+        self.store = JsonFileStore(path)
+
+    def load(self):
+        state = self.store.load()
+        return state['reports'] if state else []
+
+    def add(self, reports):
+        if reports:
+            self.store.save({'reports': self.load() + list(reports)})
+
+    # Removes the reports; returns those that were still waiting
+    def take(self, reports):
+        keys = {report['idempotency_key'] for report in reports}
+        taken = []
+        waiting = []
+
+        for report in self.load():
+            (taken if report['idempotency_key'] in keys else waiting).append(report)
+
+        self.store.save({'reports': waiting})
+
+        return taken
+
+
+# Backend shared by every container, one item per waiting report; the table
+# needs a string partition key named pk. A report is only taken by the
+# container whose delete finds it, so two containers never send it both.
+class DynamoDBBackend:
+
+    def __init__(self, dynamodb, table_name):
+        self.dynamodb = dynamodb
+        self.table_name = table_name
+
+    def load(self):
+        reports = []
+        kwargs = {'TableName': self.table_name, 'ConsistentRead': True}
+
+        while True:
+            response = self.dynamodb.scan(**kwargs)
+            reports += [json.loads(item['report']['S']) for item in response.get('Items', [])]
+
+            if 'LastEvaluatedKey' not in response:
+                return reports
+
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def add(self, reports):
+        for report in reports:
+            self.dynamodb.put_item(
+                TableName=self.table_name,
+                Item={
+                    'pk': {'S': report['idempotency_key']},
+                    'report': {'S': json.dumps(report)}
+                }
+            )
+
+    def take(self, reports):
+        taken = []
+
+        for report in reports:
+            try:
+                self.dynamodb.delete_item(
+                    TableName=self.table_name,
+                    Key={'pk': {'S': report['idempotency_key']}},
+                    ConditionExpression='attribute_exists(pk)'
+                )
+
+            # Taken by another container in the meantime
+            except self.dynamodb.exceptions.ConditionalCheckFailedException:
+                continue
+
+            taken.append(report)
+
+        return taken
+
+
+# Reports waiting for the other reports of their recipients. A recipient set
+# is due once its oldest report has waited window_seconds.
+class DigestBuffer:
+
+    def __init__(self, backend, window_seconds):
+        self.backend = backend
+        self.window_seconds = window_seconds
+
+    # Adds the reports and takes out every report of the recipient sets that
+    # are due
+    def add_and_take_due(self, reports, now=None):
+        now = time.time() if now is None else now
+
+        self.backend.add(reports)
+        buffered = self.backend.load()
+
+        oldest = {}
+
+        for report in buffered:
+            recipients = (tuple(report['recipient']), tuple(report['cc']))
+            oldest[recipients] = min(oldest.get(recipients, now), report['received'])
+
+        due = [
+            report for report in buffered
+            if now - oldest[(tuple(report['recipient']), tuple(report['cc']))] >= self.window_seconds
+        ]
+
+        return self.backend.take(due) if due else []
+
+    # Puts reports that could not be sent back for the next flush; returns
+    # those that ran out of attempts
+    def put_back(self, reports):
+        retry = []
+        dropped = []
+
+        for report in reports:
+            report = dict(report, attempts=report.get('attempts', 0) + 1)
+
+            if report['attempts'] < MAX_ATTEMPTS:
+                retry.append(report)
+
+            else:
+                dropped.append(report)
+
+        self.backend.add(retry)
+
+        return dropped
+
+
+def digest_buffer(config):
+    if config.digest_backend == 'dynamodb':
+        from client_cache import clients
+        backend = DynamoDBBackend(clients.get('dynamodb'), config.digest_table)
+
+    else:
+        backend = JsonFileBackend(config.digest_path)
+
+    return DigestBuffer(backend, config.digest_window)
@@ -0,0 +1,208 @@
+# Description: Routing table that picks the To and Cc recipients for a report
+# from its S3 key. Rules are loaded once per container from the environment,
+# a JSON file bundled with the function or a JSON object in S3, and compiled
+# so that routing a key is a single pass over it however many rules there are:
+# prefix and substring rules share one Aho-Corasick automaton, and regex rules
+# are only tried while they could still beat the best literal match.
+# Rule format and environment variables are listed in
+# sample_readme/report_router.txt
+
+# Import relevant modules
+import json
+import os
+import re
+from collections import deque
+
+RULE_TYPES = ('prefix', 'substring', 'regex')
+
+
+# Accept either a list or a comma delimited string of addresses
+def split_addresses(addresses):
+    if isinstance(addresses, str):
+        addresses = addresses.split(",")
+
+    if not isinstance(addresses, (list, tuple)) or not all(isinstance(address, str) for address in addresses):
+        raise ValueError(f'Addresses must be a string or a list of strings, got {addresses!r}')
+
+    return [address.strip() for address in addresses if address.strip()]
+
+
+class RoutingRule:
+
+    def __init__(self, match, pattern, to, cc=(), priority=0, name=None):
+        if match not in RULE_TYPES:
+            raise ValueError(f'Unknown rule type {match!r} for pattern {pattern!r}, use one of {RULE_TYPES}')
+
+        self.match = match
+        self.pattern = pattern if match == 'regex' else pattern.lower()
+        self.to = split_addresses(to)
+        self.cc = split_addresses(cc)
+        self.priority = int(priority)
+        self.name = name or pattern
+
+        if not self.to:
+            raise ValueError(f'Rule {self.name!r} has no To recipients')
+
+
+class ReportRouter:
+
+    def __init__(self, rules, default_to, default_cc):
+        self.rules = list(rules)
+        self.default_to = default_to
+        self.default_cc = default_cc
+
+        # Lower rank wins: higher priority first, then the order the rules were given in
+        self._rank = {index: (-rule.priority, index) for index, rule in enumerate(self.rules)}
+
+        literals = [(index, rule) for index, rule in enumerate(self.rules) if rule.match != 'regex']
+        self._build_automaton(literals)
+
+        self._regex_rules = sorted(
+            ((index, re.compile(rule.pattern, re.IGNORECASE)) for index, rule in enumerate(self.rules) if rule.match == 'regex'),
+            key=lambda entry: self._rank[entry[0]]
+        )
+
+    def _build_automaton(self, literals):
+        # Trie of the literal patterns; every node has its transitions, the
+        # failure link and the rules whose pattern ends there
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+
+        for index, rule in literals:
+            node = 0
+
+            for char in rule.pattern:
+                if char not in self._goto[node]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                    self._goto[node][char] = len(self._goto) - 1
+
+                node = self._goto[node][char]
+
+            self._output[node].append(index)
+
+        # Breadth first pass to set the failure links and merge the outputs;
+        # the root's children keep their failure link to the root
+        queue = deque(self._goto[0].values())
+
+        while queue:
+            node = queue.popleft()
+
+            for char, child in self._goto[node].items():
+                fail = self._fail[node]
+
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+                queue.append(child)
+
+    def match(self, filename):
+        filename = filename.lower()
+        best = None
+        node = 0
+
+        for position, char in enumerate(filename):
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+
+            node = self._goto[node].get(char, 0)
+
+            for index in self._output[node]:
+                rule = self.rules[index]
+
+                # A prefix rule only counts when the match starts at the beginning
+                if rule.match == 'prefix' and position + 1 != len(rule.pattern):
+                    continue
+
+                if best is None or self._rank[index] < self._rank[best]:
+                    best = index
+
+        # Regex rules are sorted by rank, so stop at the first one that cannot win
+        for index, regex in self._regex_rules:
+            if best is not None and self._rank[index] > self._rank[best]:
+                break
+
+            if regex.search(filename):
+                best = index
+                break
+
+        return None if best is None else self.rules[best]
+
+    def route(self, filename):
+        rule = self.match(filename)
+
+        if rule is None:
+            return self.default_to, self.default_cc
+
+        return rule.to, rule.cc
+
+
+# The original key_1/recipient_1/cc_1 variables, plus key_2, key_3 and so on,
+# become substring rules in the order of their number
+def rules_from_environment(environ):
+    rules = []
+    number = 1
+
+    while f'key_{number}' in environ:
+        rules.append(RoutingRule(
+            'substring',
+            environ[f'key_{number}'],
+            environ[f'recipient_{number}'],
+            environ.get(f'cc_{number}', ''),
+            name=f'key_{number}'
+        ))
+        number += 1
+
+    return rules
+
+
+def rules_from_json(document):
+    if isinstance(document, dict):
+        document = document.get('rules', [])
+
+    return [
+        RoutingRule(
+            rule.get('match', 'substring'),
+            rule['pattern'],
+            rule['to'],
+            rule.get('cc', []),
+            rule.get('priority', 0),
+            rule.get('name')
+        )
+        for rule in document
+    ]
+
+
+def load_router(default_to, default_cc, environ=os.environ, s3=None):
+    rules = []
+
+    # Rules given inline as JSON in the environment
+    if environ.get('routing_rules'):
+        rules += rules_from_json(json.loads(environ['routing_rules']))
+
+    # Rules in a JSON file deployed with the function
+    if environ.get('routing_rules_file'):
+        with open(environ['routing_rules_file']) as rules_file:
+            rules += rules_from_json(json.load(rules_file))
+
+    # Rules in a JSON object in S3, written as s3://bucket/key
+    if environ.get('routing_rules_s3'):
+        location = environ['routing_rules_s3']
+        bucket, _, key = location[len('s3://'):].partition('/')
+
+        if not location.startswith('s3://') or not bucket or not key:
+            raise ValueError(f'routing_rules_s3 must be written as s3://bucket/key, got {location!r}')
+
+        rules_object = s3.get_object(Bucket=bucket, Key=key)
+        rules += rules_from_json(json.loads(rules_object['Body'].read()))
+
+    rules += rules_from_environment(environ)
+
+    router = ReportRouter(rules, list(default_to), list(default_cc))
+    print(f'Loaded {len(rules)} routing rules')
+
+    return router
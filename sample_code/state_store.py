@@ -0,0 +1,41 @@
+# Description: Small JSON file store for state that should survive between
+# warm invocations, e.g. in /tmp. Writes go to a temporary file first and are
+# then moved into place, so a reader never sees a half written file.
+
+# Import relevant modules
+import json
+import os
+import tempfile
+
+
+class JsonFileStore:
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        # A missing or unreadable file is treated the same as an empty cache
+        try:
+            with open(self.path) as state_file:
+                return json.load(state_file)
+
+        except (OSError, ValueError):
+            return None
+
+    def save(self, data):
+        directory = os.path.dirname(self.path) or '.'
+        os.makedirs(directory, exist_ok=True)
+
+        handle, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+
+        try:
+            with os.fdopen(handle, 'w') as temp_file:
+                json.dump(data, temp_file)
+
+            os.replace(temp_path, self.path)
+
+        except OSError as e:
+            print(f'Could not save state to {self.path}: {e}')
+
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
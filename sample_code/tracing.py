@@ -0,0 +1,134 @@
+# Description: Lightweight per-invocation tracing for the sample handlers.
+# span() times a stage, as a context manager or a decorator, and every call made
+# through a traced boto3 client is timed as a span named after the service and
+# operation, e.g. connect.GetMetricData. The handler decorated with
+# @traced_handler writes one JSON summary line per invocation with the count,
+# total and slowest time of each span and whether the container was cold.
+
+# Import relevant modules
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Tracer:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._spans = {}
+
+        self.invocation_count = 0
+
+    def reset(self):
+        with self._lock:
+            self._spans = {}
+
+    def record(self, name, seconds):
+        with self._lock:
+            span = self._spans.get(name)
+
+            if span is None:
+                span = self._spans[name] = {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+
+            milliseconds = seconds * 1000
+            span['count'] += 1
+            span['total_ms'] += milliseconds
+            span['max_ms'] = max(span['max_ms'], milliseconds)
+
+    @contextmanager
+    def span(self, name):
+        started = time.perf_counter()
+
+        try:
+            yield
+
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    # Decorator form of span, named after the function unless a name is given
+    def traced(self, name=None):
+        def decorator(function):
+            span_name = name or function.__name__
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(span_name):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def summary(self):
+        with self._lock:
+            return {
+                name: {'count': span['count'], 'total_ms': round(span['total_ms'], 1), 'max_ms': round(span['max_ms'], 1)}
+                for name, span in sorted(self._spans.items())
+            }
+
+    # Time every API call made through a boto3 client; clients without botocore
+    # events (e.g. local stand-ins) are left alone
+    def instrument_client(self, client):
+        events = getattr(getattr(client, 'meta', None), 'events', None)
+
+        if events is None:
+            return
+
+        service = client.meta.service_model.service_name
+
+        # The botocore request context travels with the call, so concurrent
+        # calls on the same client do not mix up their start times
+        def before_call(model, context, **kwargs):
+            context['trace_span'] = (f'{service}.{model.name}', time.perf_counter())
+
+        # Also called for calls that fail before a response arrives, which do
+        # not pass the operation model
+        def after_call(context, **kwargs):
+            trace_span = context.pop('trace_span', None)
+
+            if trace_span is not None:
+                self.record(trace_span[0], time.perf_counter() - trace_span[1])
+
+        events.register('before-call.*.*', before_call, unique_id='tracing-before-call')
+        events.register('after-call.*.*', after_call, unique_id='tracing-after-call')
+        events.register('after-call-error.*.*', after_call, unique_id='tracing-after-call-error')
+
+    # Decorator for lambda_handler: starts a fresh set of spans, times the whole
+    # invocation and prints the summary line when it ends, also on an error
+    def traced_handler(self, handler_name):
+        def decorator(function):
+
+            @functools.wraps(function)
+            def wrapper(event, context):
+                self.reset()
+                self.invocation_count += 1
+                cold = self.invocation_count == 1
+                started = time.perf_counter()
+                status = 'error'
+
+                try:
+                    result = function(event, context)
+                    status = 'ok'
+                    return result
+
+                finally:
+                    print(json.dumps({
+                        'trace': handler_name,
+                        'cold': cold,
+                        'status': status,
+                        'duration_ms': round((time.perf_counter() - started) * 1000, 1),
+                        'spans': self.summary()
+                    }))
+
+            return wrapper
+
+        return decorator
+
+
+# One tracer per container, shared by the handler and the helper modules
+tracer = Tracer()
+span = tracer.span
+traced = tracer.traced
+traced_handler = tracer.traced_handler